@@ -0,0 +1,210 @@
+import operator
+import re
+
+# Power formulas like  40 + fan.speedIndex * 25 + (heater.onOffState ? 1500 : 0)
+# are parsed once into a tree of closures, so evaluating one is a few Python calls
+# and dictionary lookups, no eval. Inputs are written alias.state, the aliases are
+# mapped to devices by the meter.
+#
+#   expression  := condition ['?' expression ':' expression]
+#   condition   := conjunction {('||' | 'or') conjunction}
+#   conjunction := negation {('&&' | 'and') negation}
+#   negation    := ('!' | 'not') negation | comparison
+#   comparison  := sum [('==' | '!=' | '<' | '<=' | '>' | '>=') sum]
+#   sum         := product {('+' | '-') product}
+#   product     := unary {('*' | '/' | '%') unary}
+#   unary       := ('-' | '+') unary | primary
+#   primary     := number | string | true | false | alias.state | function(expression, ...) | (expression)
+TOKEN = re.compile(r"\s*(?:(\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)|([A-Za-z_]\w*)|"
+                   r"\"([^\"]*)\"|'([^']*)'|(==|!=|<=|>=|&&|\|\||[-+*/%<>!?:().,]))")
+COMPARISONS = {"==": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le,
+               ">": operator.gt, ">=": operator.ge}
+ARITHMETIC = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv, "%": operator.mod}
+FUNCTIONS = {"min": min, "max": max, "abs": abs, "round": round}
+KEYWORDS = {"true": True, "false": False}
+
+
+class FormulaError(ValueError):
+    pass
+
+
+class Formula:
+    def __init__(self, text):
+        self.text = text
+        self.inputs = set()
+        self.tokens = tokenize(text)
+        self.pos = 0
+        self.evaluate = self._expression()
+        if self.pos < len(self.tokens):
+            raise FormulaError(f"Unexpected {self.tokens[self.pos][1]!r} at position {self.tokens[self.pos][2]}")
+        del self.tokens
+
+    def aliases(self):
+        return {alias for alias, state in self.inputs}
+
+    # The compiled formula is called with the states of every alias, {alias: {state: value}}
+    def __call__(self, states):
+        return self.evaluate(states)
+
+    ########################################
+    # Parser
+    ######################
+    def _next(self):
+        if self.pos >= len(self.tokens):
+            raise FormulaError("The formula ends too early")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _expect(self, symbol):
+        kind, value, position = self._next()
+        if value != symbol or kind != "symbol":
+            raise FormulaError(f"Expected {symbol!r} at position {position}")
+
+    def _accept(self, *symbols):
+        if self.pos < len(self.tokens) and self.tokens[self.pos][0] in ("symbol", "name") \
+                and self.tokens[self.pos][1] in symbols:
+            self.pos += 1
+            return self.tokens[self.pos - 1][1]
+        return None
+
+    def _expression(self):
+        condition = self._condition()
+        if not self._accept("?"):
+            return condition
+        whenTrue = self._expression()
+        self._expect(":")
+        whenFalse = self._expression()
+        return fold(lambda states: whenTrue(states) if condition(states) else whenFalse(states), condition, whenTrue, whenFalse)
+
+    def _condition(self):
+        left = self._conjunction()
+        while self._accept("||", "or"):
+            left = either(left, self._conjunction())
+        return left
+
+    def _conjunction(self):
+        left = self._negation()
+        while self._accept("&&", "and"):
+            left = both(left, self._negation())
+        return left
+
+    def _negation(self):
+        if self._accept("!", "not"):
+            operand = self._negation()
+            return fold(lambda states: not operand(states), operand)
+        return self._comparison()
+
+    def _comparison(self):
+        left = self._sum()
+        symbol = self._accept(*COMPARISONS)
+        if symbol:
+            left = self._binary(COMPARISONS[symbol], left, self._sum())
+        return left
+
+    def _sum(self):
+        left = self._product()
+        while True:
+            symbol = self._accept("+", "-")
+            if not symbol:
+                return left
+            left = self._binary(ARITHMETIC[symbol], left, self._product())
+
+    def _product(self):
+        left = self._unary()
+        while True:
+            symbol = self._accept("*", "/", "%")
+            if not symbol:
+                return left
+            left = self._binary(ARITHMETIC[symbol], left, self._unary())
+
+    def _unary(self):
+        symbol = self._accept("-", "+")
+        if symbol == "-":
+            operand = self._unary()
+            return fold(lambda states: -operand(states), operand)
+        if symbol == "+":
+            return self._unary()
+        return self._primary()
+
+    def _primary(self):
+        kind, value, position = self._next()
+        if kind in ("number", "string"):
+            return constant(value)
+        if kind == "name":
+            if value in KEYWORDS:
+                return constant(KEYWORDS[value])
+            if value in FUNCTIONS:
+                return self._call(FUNCTIONS[value])
+            if self._accept("."):
+                stateKind, state, statePosition = self._next()
+                if stateKind != "name":
+                    raise FormulaError(f"Expected a state name after {value}. at position {statePosition}")
+                self.inputs.add((value, state))
+                return lambda states: states[value].get(state) or 0
+            raise FormulaError(f"{value} at position {position} is not an input, write inputs as alias.state")
+        if value == "(":
+            expression = self._expression()
+            self._expect(")")
+            return expression
+        raise FormulaError(f"Unexpected {value!r} at position {position}")
+
+    def _call(self, function):
+        self._expect("(")
+        arguments = [self._expression()]
+        while self._accept(","):
+            arguments.append(self._expression())
+        self._expect(")")
+        return fold(lambda states: function(*[argument(states) for argument in arguments]), *arguments)
+
+    def _binary(self, function, left, right):
+        return fold(lambda states: function(left(states), right(states)), left, right)
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = TOKEN.match(text, pos)
+        if match is None:
+            position = len(text) - len(text[pos:].lstrip())
+            raise FormulaError(f"Unexpected {text[position]!r} at position {position + 1}")
+        number, name, doubleQuoted, singleQuoted, symbol = match.groups()
+        position = match.start(match.lastindex) + 1
+        if number is not None:
+            tokens.append(("number", float(number), position))
+        elif name is not None:
+            tokens.append(("name", name, position))
+        elif doubleQuoted is not None or singleQuoted is not None:
+            tokens.append(("string", doubleQuoted if doubleQuoted is not None else singleQuoted, position))
+        else:
+            tokens.append(("symbol", symbol, position))
+        pos = match.end()
+    if not tokens:
+        raise FormulaError("The formula is empty")
+    return tokens
+
+
+def either(left, right):
+    return fold(lambda states: left(states) or right(states), left, right)
+
+
+def both(left, right):
+    return fold(lambda states: left(states) and right(states), left, right)
+
+
+def constant(value):
+    evaluate = lambda states: value
+    evaluate.constant = True
+    return evaluate
+
+
+def fold(evaluate, *operands):
+    # Parts without inputs, like 1500 * 0.9, are worked out once here
+    if all(getattr(operand, "constant", False) for operand in operands):
+        try:
+            return constant(evaluate({}))
+        except (ArithmeticError, TypeError) as e:
+            raise FormulaError(f"Can not be worked out: {e}")
+    return evaluate
@@ -0,0 +1,216 @@
+import mmap
+import os
+import struct
+import time
+
+# Every meter gets three append-only files of fixed 16 byte records, all sorted on
+# their first field so they can be searched in place through mmap:
+#   <id>.seg   power segments (start timestamp, watts), a new one every time the power changes
+#   <id>.hour  hourly rollup (local hour start, kWh)
+#   <id>.day   daily rollup (local midnight, kWh)
+# Rollups are updated when a segment closes, so only the open segment is not in them yet.
+RECORD = struct.Struct("<dd")
+
+
+class RecordLog:
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.firstRecord = None
+        self.lastRecord = None
+        if os.path.exists(path):
+            self.count = os.path.getsize(path) // RECORD.size
+            if self.count:
+                with open(path, "rb") as f:
+                    self.firstRecord = RECORD.unpack(f.read(RECORD.size))
+                    f.seek((self.count - 1) * RECORD.size)
+                    self.lastRecord = RECORD.unpack(f.read(RECORD.size))
+
+    def append(self, key, value):
+        with open(self.path, "ab") as f:
+            f.write(RECORD.pack(key, value))
+        self.count += 1
+        self.lastRecord = (key, value)
+        if self.firstRecord is None:
+            self.firstRecord = self.lastRecord
+
+    def replaceLast(self, key, value):
+        with open(self.path, "r+b") as f:
+            f.seek((self.count - 1) * RECORD.size)
+            f.write(RECORD.pack(key, value))
+        self.lastRecord = (key, value)
+        if self.count == 1:
+            self.firstRecord = self.lastRecord
+
+    def addToBucket(self, key, value):
+        if self.lastRecord is None or key > self.lastRecord[0]:
+            self.append(key, value)
+        elif key == self.lastRecord[0]:
+            self.replaceLast(key, self.lastRecord[1] + value)
+        else:
+            # Only happens if the clock went backwards, rewrite the whole log
+            records = dict(self.records(float("-inf"), float("inf")))
+            records[key] = records.get(key, 0.0) + value
+            self._rewrite(sorted(records.items()))
+
+    def records(self, start, end, includePrevious=False):
+        # Records with start <= key < end, optionally with the one before start
+        # (the segment that was active at start)
+        if not self.count:
+            return []
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            lo = self._bisect(m, start)
+            hi = self._bisect(m, end)
+            if includePrevious and lo > 0:
+                lo -= 1
+            return [RECORD.unpack_from(m, i * RECORD.size) for i in range(lo, hi)]
+
+    def truncateBefore(self, key):
+        # Drop records before key, keeping the one that is still active at key
+        if not self.count or self.firstRecord[0] >= key:
+            return
+        records = self.records(key, float("inf"), includePrevious=True)
+        self._rewrite(records)
+
+    def _bisect(self, m, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if RECORD.unpack_from(m, mid * RECORD.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _rewrite(self, records):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            f.write(b"".join(RECORD.pack(key, value) for key, value in records))
+        os.replace(tmpPath, self.path)
+        self.count = len(records)
+        self.firstRecord = tuple(records[0]) if records else None
+        self.lastRecord = tuple(records[-1]) if records else None
+
+
+class EnergyHistory:
+    def __init__(self, folder):
+        self.folder = folder
+        self.logs = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def _logs(self, devId):
+        logs = self.logs.get(devId)
+        if logs is None:
+            base = os.path.join(self.folder, str(devId))
+            logs = self.logs[devId] = (RecordLog(base + ".seg"), RecordLog(base + ".hour"), RecordLog(base + ".day"))
+        return logs
+
+    def recordPower(self, devId, ts, watts):
+        segments, hours, days = self._logs(devId)
+        if segments.lastRecord is not None:
+            start, lastWatts = segments.lastRecord
+            if lastWatts == watts:
+                return
+            if ts <= start:
+                segments.replaceLast(start, watts)
+                return
+            if lastWatts:
+                self._rollup(hours, hourStart, nextHour, start, ts, lastWatts)
+                self._rollup(days, dayStart, nextDay, start, ts, lastWatts)
+        segments.append(ts, watts)
+
+    def _rollup(self, log, bucketStart, nextBucket, start, end, watts):
+        ts = start
+        while ts < end:
+            bucket = bucketStart(ts)
+            bucketEnd = min(nextBucket(bucket), end)
+            log.addToBucket(bucket, ((bucketEnd - ts) / 3600 * watts) / 1000)
+            ts = bucketEnd
+
+    def energyBetween(self, devId, start, end, now=None):
+        now = time.time() if now is None else now
+        end = min(end, now)
+        segments, hours, days = self._logs(devId)
+        if end <= start or segments.lastRecord is None:
+            return 0.0
+        openStart, openWatts = segments.lastRecord
+        energy = 0.0
+        for kind, a, b in self._pieces(start, end):
+            if kind == "raw" and a >= segments.firstRecord[0]:
+                energy += self._integrate(segments.records(a, b, includePrevious=True), a, b, now)
+                continue
+            if kind == "raw":
+                # Raw segments have been compacted, prorate the hour instead
+                hour = hourStart(a)
+                energy += sum(kwh for key, kwh in hours.records(hour, hour + 1)) * (b - a) / (nextHour(hour) - hour)
+            else:
+                energy += sum(kwh for key, kwh in (days if kind == "day" else hours).records(a, b))
+            # The open segment is not in the rollups yet
+            overlap = min(b, now) - max(a, openStart)
+            if overlap > 0:
+                energy += (overlap / 3600 * openWatts) / 1000
+        return energy
+
+    def _integrate(self, records, start, end, now):
+        energy = 0.0
+        for i, (segmentStart, watts) in enumerate(records):
+            segmentEnd = records[i + 1][0] if i + 1 < len(records) else now
+            overlap = min(segmentEnd, end) - max(segmentStart, start)
+            if overlap > 0:
+                energy += (overlap / 3600 * watts) / 1000
+        return energy
+
+    def _pieces(self, start, end):
+        # Whole days come from the daily rollup, whole hours from the hourly rollup
+        # and only the edges are integrated from raw segments
+        firstDay = ceilBucket(start, dayStart, nextDay)
+        lastDay = dayStart(end)
+        if firstDay < lastDay:
+            return self._hourPieces(start, firstDay) + [("day", firstDay, lastDay)] + self._hourPieces(lastDay, end)
+        return self._hourPieces(start, end)
+
+    def _hourPieces(self, start, end):
+        firstHour = ceilBucket(start, hourStart, nextHour)
+        lastHour = hourStart(end)
+        if firstHour < lastHour:
+            pieces = [("raw", start, firstHour), ("hour", firstHour, lastHour), ("raw", lastHour, end)]
+        else:
+            pieces = [("raw", start, end)]
+        return [(kind, a, b) for kind, a, b in pieces if a < b]
+
+    def compact(self, rawBefore, hourlyBefore):
+        for name in os.listdir(self.folder):
+            devId, ext = os.path.splitext(name)
+            if ext == ".seg" and devId.isdigit():
+                segments, hours, days = self._logs(int(devId))
+                segments.truncateBefore(rawBefore)
+                hours.truncateBefore(hourlyBefore)
+
+
+def hourStart(ts):
+    local = time.localtime(ts)
+    return float(int(ts) - local.tm_min * 60 - local.tm_sec)
+
+
+def nextHour(ts):
+    return ts + 3600
+
+
+def dayStart(ts):
+    local = time.localtime(ts)
+    return time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1))
+
+
+def nextDay(ts):
+    local = time.localtime(ts)
+    return time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+
+def monthStart(ts):
+    local = time.localtime(ts)
+    return time.mktime((local.tm_year, local.tm_mon, 1, 0, 0, 0, 0, 0, -1))
+
+
+def ceilBucket(ts, bucketStart, nextBucket):
+    bucket = bucketStart(ts)
+    return bucket if bucket == ts else nextBucket(bucket)
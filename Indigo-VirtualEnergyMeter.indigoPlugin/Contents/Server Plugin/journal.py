@@ -0,0 +1,75 @@
+import math
+import os
+import struct
+
+# Write-ahead journal of every meter's accumulation state, appended before the states are
+# sent to the server. Each record is (device id, kWh, settled up to timestamp, watts since then),
+# a NaN timestamp marks a deleted meter. Only the last record of a meter matters, so the file
+# is rewritten with just those once it has grown to several times their number.
+RECORD = struct.Struct("<qddd")
+MIN_COMPACT_RECORDS = 1000
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.latest = {}
+        self.count = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            self._load()
+        self.file = open(path, "ab")
+        self.dirty = False
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.count = len(data) // RECORD.size
+        for devId, accumKwh, ts, watts in RECORD.iter_unpack(data[:self.count * RECORD.size]):
+            if math.isnan(ts):
+                self.latest.pop(devId, None)
+            else:
+                self.latest[devId] = (accumKwh, ts, watts)
+        if len(data) % RECORD.size:
+            # A crash in the middle of a write leaves a partial record at the end
+            with open(self.path, "r+b") as f:
+                f.truncate(self.count * RECORD.size)
+
+    def append(self, records):
+        if not records:
+            return
+        self.file.write(b"".join(RECORD.pack(devId, accumKwh, ts, watts) for devId, accumKwh, ts, watts in records))
+        for devId, accumKwh, ts, watts in records:
+            self.latest[devId] = (accumKwh, ts, watts)
+        self.count += len(records)
+        self.dirty = True
+        if self.count > max(MIN_COMPACT_RECORDS, 4 * len(self.latest)):
+            self.compact()
+
+    def forget(self, devId):
+        if self.latest.pop(devId, None) is not None:
+            self.file.write(RECORD.pack(devId, 0.0, math.nan, 0.0))
+            self.count += 1
+            self.dirty = True
+
+    def sync(self):
+        if self.dirty:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def compact(self):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            f.write(b"".join(RECORD.pack(devId, *state) for devId, state in self.latest.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(tmpPath, self.path)
+        self.file = open(self.path, "ab")
+        self.count = len(self.latest)
+        self.dirty = False
+
+    def close(self):
+        self.sync()
+        self.file.close()
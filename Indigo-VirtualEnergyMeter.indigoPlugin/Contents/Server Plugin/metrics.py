@@ -0,0 +1,121 @@
+import http.server
+import json
+import threading
+import time
+
+# Serves every meter's watts, kWh and last update on a local HTTP port, so dashboards can
+# read them without asking the Indigo server:
+#   /metrics       Prometheus text format
+#   /metrics.json  JSON
+# The plugin's worker only replaces entries in the readings dict and bumps the version.
+# Request threads copy the dict and render it when the version has moved, and keep the
+# rendered bytes for the requests after them. They never take a lock the worker uses.
+PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+JSON_TYPE = "application/json"
+PROMETHEUS_METRICS = [
+    ("watts", "gauge", "Current power of the meter in watts", 2),
+    ("energy_kwh_total", "counter", "Energy counted by the meter in kWh", 3),
+    ("last_update_timestamp_seconds", "gauge", "When the meter's readings last changed", 4),
+]
+
+
+def escapeLabel(text):
+    return text.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def renderPrometheus(readings):
+    lines = []
+    labels = {devId: f'id="{devId}",name="{escapeLabel(reading[0])}",type="{reading[1]}"'
+              for devId, reading in readings.items()}
+    for name, kind, description, field in PROMETHEUS_METRICS:
+        lines.append(f"# HELP virtual_energy_meter_{name} {description}")
+        lines.append(f"# TYPE virtual_energy_meter_{name} {kind}")
+        for devId in sorted(readings):
+            lines.append(f"virtual_energy_meter_{name}{{{labels[devId]}}} {readings[devId][field]!r}")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def renderJSON(readings):
+    return json.dumps({"generated": time.time(), "meters": [
+        {"id": devId, "name": name, "type": deviceType, "watts": watts, "kwh": kwh, "updated": updated}
+        for devId, (name, deviceType, watts, kwh, updated) in sorted(readings.items())]}).encode()
+
+
+RENDERERS = {
+    "/metrics": (renderPrometheus, PROMETHEUS_TYPE),
+    "/metrics.json": (renderJSON, JSON_TYPE),
+}
+
+
+class MetricsServer:
+    def __init__(self, address, port, logger):
+        self.logger = logger
+        self.readings = {}
+        self.version = 0
+        self.rendered = {}
+        self.renderLock = threading.Lock()
+        self.httpd = http.server.ThreadingHTTPServer((address, port), self._handlerClass())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metricsServer", daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        return self.httpd.server_address[:2]
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    ########################################
+    # Worker side
+    ######################
+    def update(self, devId, name, deviceType, watts, kwh, ts):
+        # None keeps the meter's last reading
+        reading = self.readings.get(devId)
+        if reading is not None:
+            watts = reading[2] if watts is None else watts
+            kwh = reading[3] if kwh is None else kwh
+            if reading[:4] == (name, deviceType, watts, kwh):
+                return
+        self.readings[devId] = (name, deviceType, watts or 0.0, kwh or 0.0, ts)
+        self.version += 1
+
+    def remove(self, devId):
+        if self.readings.pop(devId, None) is not None:
+            self.version += 1
+
+    ########################################
+    # Request side
+    ######################
+    def render(self, path):
+        renderer, contentType = RENDERERS[path]
+        with self.renderLock:
+            version, body = self.rendered.get(path, (None, None))
+            if version != self.version:
+                version = self.version
+                body = renderer(dict(self.readings))
+                self.rendered[path] = (version, body)
+        return body, contentType
+
+    def _handlerClass(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path not in RENDERERS:
+                    self.send_error(404, "Try /metrics or /metrics.json")
+                    return
+                body, contentType = server.render(path)
+                self.send_response(200)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server.logger.debug(f"Metrics request from {self.client_address[0]}: {format % args}")
+
+        return Handler
@@ -1,159 +1,1421 @@
+import bisect
+import collections
+import concurrent.futures
+import heapq
 import logging
-import numpy as np
+import os
+import threading
 import time
 
+import formula
+import history
+import journal
+import metrics
+import stats
+import tariff
+
 try:
     # noinspection PyUnresolvedReferences
     import indigo
 except ImportError:
     pass
 
+# Methods timed when instrumentation is on, with the name they are reported under
+INSTRUMENTED_METHODS = {
+    "deviceUpdated": "deviceUpdated",
+    "deviceDeleted": "deviceDeleted",
+    "_handleDeviceUpdated": "device update",
+    "_handleDeviceDeleted": "device delete",
+    "_refreshState": "_refreshState",
+    "_addAccumEnergy": "_addAccumEnergy",
+    "getCurPower": "getCurPower",
+    "_runLoopOnce": "tick",
+    "_getDevice": "device lookup",
+    "_deviceExists": "device check",
+    "_iterDevices": "device walk",
+    "_flushStates": "state flush",
+}
+# Methods covered by Profile Plugin, calls made inside them are profiled too
+PROFILED_METHODS = ("deviceUpdated", "_runLoopOnce", "_refreshState")
+PROFILE_MAX_SECONDS = 600
+PROFILE_MAX_CALLS = 1000000
+# Saved profiles larger than this lose the functions that took the least time
+PROFILE_MAX_BYTES = 8 * 1024 * 1024
+# Devices that can be in the config dialogs' device lists
+PICKER_FILTER = "indigo.relay, indigo.dimmer, indigo.sensor, props.SupportsOnState, props.SupportsEnergyMeter"
+# Figures published on Plugin Statistics devices, as <state>Calls and <state>P95
+STATISTICS_STATES = {
+    "deviceUpdated": "deviceUpdated",
+    "tick": "tick",
+    "_refreshState": "refreshState",
+    "device lookup": "deviceLookup",
+    "device check": "deviceCheck",
+    "device walk": "deviceWalk",
+    "state flush": "stateFlush",
+}
+JOURNAL_SYNC_INTERVAL = 2
+# Statistics devices are written at most this often, every write is a server call of its own
+STATISTICS_INTERVAL = 10
+# States of watched devices kept locally, and how long before they are fetched again
+MIRRORED_STATES = ("onOffState", "brightnessLevel", "curEnergyLevel")
+MIRROR_MAX_AGE = 3600
+# Flushes smaller than this many writes per thread are not worth handing to the pool
+FLUSH_POOL_MIN_WRITES = 2
+
 class Plugin(indigo.PluginBase):
     def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
         super(Plugin, self).__init__(pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
         self.logger.setLevel(logging.INFO)
-        self.parentDevIdsWeUseDict = []
+        self.history = None
+        self.historyCompactedTS = 0
+        self.coalesceWindow = 0.0
+        self.publishMinWatts = 0.0
+        self.publishMinKwh = 0.0
+        self.publishMaxAge = 0.0
+        self.groupFromChildEnergy = False
+        self.groupWattsHeld = False
+        self.tariff = None
+        self.flushPool = None
+        self.flushThreads = 1
+        self.flushWidth = 1
+        self.flushLatency = None
+        self.metrics = None
+        self.instrumentation = None
+        self.profiler = None
+        self.pickerEntries = None
+        self.pickerLists = {}
+        self.pickerAttributes = set()
+        self.journal = None
+        self.journalSyncTS = 0
+        self.resumeStates = {}
+        self.wakeEvent = threading.Event()
+        self.eventQueue = collections.deque()
+        self.eventLock = threading.RLock()
+        self.eventFloorTS = 0
+        self.workerRunning = False
+        self.startingDevices = None
+        self.launchTS = time.perf_counter()
+        self.startupTS = self.launchTS
+        self._resetMeterState()
 
     def startup(self):
         self.setLogLevel()
         self.logger.debug("startup called")
         indigo.devices.subscribeToChanges()
-        self.parentDevIdsWeUseDict = []
+        self._resetMeterState()
+        self._openJournal()
+        self._setupHistory()
+        self._readCoalesceWindow()
+        self._readPublishThresholds()
+        self._readGroupAccumulation()
+        self._setupTariff()
+        self._setupFlushPool()
+        self._setupInstrumentation()
+        # deviceStartComm only collects the devices until the concurrent thread starts them all at once
+        self.startingDevices = {}
+        # After startingDevices, _finishStartup adds the meters to the endpoint in its one pass
+        self._setupMetrics()
+        self.startupTS = time.perf_counter()
 
     def shutdown(self):
         self.logger.debug("shutdown called")
-
-    def _refreshState(self, dev, logRefresh=False):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.flushPool is not None:
+            self.flushPool.shutdown()
+            self.flushPool = None
+        if self.metrics is not None:
+            self.metrics.close()
+            self.metrics = None
+
+    def stopConcurrentThread(self):
+        super(Plugin, self).stopConcurrentThread()
+        self.wakeEvent.set()
+
+    def _resetMeterState(self):
+        self.meterIdsByParentId = {}
+        self.groupIdsByChildId = {}
+        self.watchedIdsByMeterId = {}
+        self.meterRanks = {}
+        self.meterWatts = {}
+        self.groupWatts = {}
+        self.powerCurves = {}
+        self.curveStack = None
+        self.periodEnergy = {}
+        self.periodStarts = (None, None)
+        self.periodRolloverTS = 0
+        self.refreshQueue = []
+        self.refreshDue = {}
+        self.refreshIntervals = {}
+        self.pollDue = {}
+        self.nextPollTS = 0
+        self.deferredDeltas = {}
+        self.coalesceFlushTS = 0
+        self.pendingStates = {}
+        self.heldStates = {}
+        self.publishedStates = {}
+        self.heldCheckTS = 0
+        self.stateWrites = 0
+        self.stateWritesAvoided = 0
+        self.echoesDropped = 0
+        self.flushTime = 0.0
+        self.flushWrites = 0
+        self.statsDeviceIds = set()
+        self.statisticsTS = 0
+        self.stateMirror = {}
+        self.mirrorKeys = {}
+        self.formulas = {}
+        self.formulaWatts = {}
+        self.settledTS = {}
+
+    def _refreshState(self, dev, logRefresh=False, ts=None):
 
         keyValueList = []
+        watts = None
+        ts = time.time() if ts is None else ts
         if dev.deviceTypeId == "virtualDeviceEnergyMeter":
-            # TODO: Fix error handling if parentDevice doesn't exist
-            if int(dev.ownerProps["parentDeviceId"]) not in indigo.devices:
+            parentStates = self._watchedStates(int(dev.ownerProps["parentDeviceId"]))
+            if parentStates is None:
                 self.logger.warn("Parent device  does not exist any more")
                 return
-            parentDevice = indigo.devices[int(dev.ownerProps["parentDeviceId"])]
-            ts = time.time()
             if "curEnergyLevel" in dev.states:
-                if parentDevice.states['onOffState']:
-                    if "brightnessLevel" in parentDevice.states:
-                        watts = self.getCurPower(dev, int(parentDevice.states.get("brightnessLevel")))
+                if parentStates['onOffState']:
+                    if "brightnessLevel" in parentStates:
+                        watts = self.getCurPower(dev, int(parentStates.get("brightnessLevel")))
                     else:
                         watts = float(dev.ownerProps["powerAtOn"])
                     wattsStr = f"{watts:.2f} W"
-                    accumEnergyTotalTS = dev.states.get("accumEnergyTotalTS", ts)
-                    if accumEnergyTotalTS == 0:
-                        accumEnergyTotalTS = ts
-                    energy = ((ts - accumEnergyTotalTS) / 3600 * watts) / 1000
-                    self._addAccumEnergy(dev, energy, ts)
                 else:
                     watts = 0.0
                     wattsStr = f"{watts} W"
-                    self._addAccumEnergy(dev, 0, ts)
+                self._settleMeter(dev, ts, watts)
                 keyValueList.append(
                     {'key': 'curEnergyLevel', 'value': watts, 'uiValue': wattsStr})
-        elif dev.deviceTypeId == "virtualGroupEnergyMeter" and "childEnergyMeters" in dev.ownerProps:
-            ts = time.time()
-            accumEnergyTotalTS = dev.states.get("accumEnergyTotalTS", ts)
-            if accumEnergyTotalTS == 0:
-                accumEnergyTotalTS = ts
-            watts = 0.0
-            power = 0.0
-            for devId in dev.ownerProps["childEnergyMeters"]:
-                if int(devId) in indigo.devices:
-                    childWatt = indigo.devices[int(devId)].states.get('curEnergyLevel', 0)
-                    watts += childWatt
-                    power += ((ts - accumEnergyTotalTS) / 3600 * childWatt) / 1000
-            self._addAccumEnergy(dev, power, ts)
-            wattsStr = f"{watts:.2f} W"
+        elif dev.deviceTypeId == "virtualFormulaEnergyMeter":
+            watts = self._formulaPower(dev)
+            if watts is None:
+                return
+            self._settleMeter(dev, ts, watts)
             keyValueList.append(
-                {'key': 'curEnergyLevel', 'value': watts, 'uiValue': wattsStr})
-        dev.updateStatesOnServer(keyValueList)
-
-    def _addAccumEnergy(self, dev, energy, ts, resetTS=True, resetWatt=False):
+                {'key': 'curEnergyLevel', 'value': watts, 'uiValue': f"{watts:.2f} W"})
+        elif dev.deviceTypeId == "virtualGroupEnergyMeter" and "childEnergyMeters" in dev.ownerProps:
+            watts = self._settleGroup(dev, ts, keyValueList)
+        self._queueStates(dev, keyValueList)
+        if watts is not None:
+            self._applyWattsChange(dev.id, watts, ts)
+
+    def _settleMeter(self, dev, ts, watts):
+        # Energy since the last settlement is charged at the power that was in effect
+        # during that interval, falling back to the new power if it is not known yet
+        settledWatts = self.meterWatts.get(dev.id, watts)
+        accumEnergyTotalTS = self._stateValue(dev, "accumEnergyTotalTS", ts)
+        if accumEnergyTotalTS == 0:
+            accumEnergyTotalTS = ts
+        self._addAccumEnergy(dev, ((ts - accumEnergyTotalTS) / 3600 * settledWatts) / 1000, ts)
+
+    def _addAccumEnergy(self, dev, energy, ts, resetTS=True, resetWatt=False, start=None):
+        # start is when the power the energy was used at began, the last settlement if not given
         keyValueList = []
         if "accumEnergyTotal" in dev.states:
-            accumKwh = dev.states.get("accumEnergyTotal", 0) + energy
+            if start is None:
+                start = self._stateValue(dev, "accumEnergyTotalTS", ts) or ts
+            accumKwh = self._stateValue(dev, "accumEnergyTotal", 0) + energy
             accumKwhStr = f"{accumKwh:.3f} kWh"
             keyValueList.append(
                 {'key': 'accumEnergyTotal', 'value': accumKwh, 'uiValue': accumKwhStr})
+            if "energyToday" in dev.states:
+                self._addPeriodEnergy(dev, energy, ts, keyValueList, start)
+            if self.tariff is not None and "accumCostTotal" in dev.states:
+                self._addCost(dev, energy, start, ts, keyValueList)
             if resetTS:
                 keyValueList.append(
                     {'key': 'accumEnergyTotalTS', 'value': ts, 'uiValue': f"{ts}"})
+                self.settledTS[dev.id] = ts
             if resetWatt:
                 keyValueList.append(
                     {'key': 'curEnergyLevel', 'value': 0, 'uiValue': "0 Watt"})
-            dev.updateStatesOnServer(keyValueList)
+            self._queueStates(dev, keyValueList)
+            if energy and self.groupFromChildEnergy and dev.id in self.groupIdsByChildId:
+                self._addChildEnergy(dev.id, energy, ts, start)
+
+    ########################################
+    # Period energy
+    ######################
+    def _periodEnergy(self, dev):
+        periods = self.periodEnergy.get(dev.id)
+        if periods is None:
+            # The stored period states belong to the periods of the last accumulation
+            lastTS = self._stateValue(dev, "accumEnergyTotalTS", 0)
+            periods = self.periodEnergy[dev.id] = {
+                "hour": [history.hourStart(lastTS), self._stateValue(dev, "energyThisHour", 0.0) or 0.0],
+                "lastHour": self._stateValue(dev, "energyLastHour", 0.0) or 0.0,
+                "day": [history.dayStart(lastTS), self._stateValue(dev, "energyToday", 0.0) or 0.0],
+                "month": [history.monthStart(lastTS), self._stateValue(dev, "energyThisMonth", 0.0) or 0.0]}
+        return periods
+
+    def _addPeriodEnergy(self, dev, energy, ts, keyValueList, start):
+        periods = self._periodEnergy(dev)
+
+        def share(periodStart, periodEnd):
+            # Part of the energy that falls in the period, the power is constant over the interval
+            if ts <= start:
+                return energy if periodStart <= ts < periodEnd else 0.0
+            return energy * max(min(ts, periodEnd) - max(start, periodStart), 0) / (ts - start)
+
+        hourStart, dayStart, monthStart = self._periodStartsAt(ts)
+        if periods["hour"][0] != hourStart:
+            previousHour = periods["hour"][1] if periods["hour"][0] == hourStart - 3600 else 0.0
+            periods["lastHour"] = previousHour + share(hourStart - 3600, hourStart)
+            periods["hour"] = [hourStart, 0.0]
+        for period, periodStart in (("hour", hourStart), ("day", dayStart), ("month", monthStart)):
+            if periods[period][0] != periodStart:
+                periods[period] = [periodStart, 0.0]
+            periods[period][1] += share(periodStart, float("inf"))
+        for key, kwh in (("energyThisHour", periods["hour"][1]), ("energyLastHour", periods["lastHour"]),
+                         ("energyToday", periods["day"][1]), ("energyThisMonth", periods["month"][1])):
+            keyValueList.append({'key': key, 'value': kwh, 'uiValue': f"{kwh:.3f} kWh"})
+
+    def _periodStartsAt(self, ts):
+        # A refresh pass settles every meter at the same time, the starts are worked out once
+        if self.periodStarts[0] != ts:
+            self.periodStarts = (ts, (history.hourStart(ts), history.dayStart(ts), history.monthStart(ts)))
+        return self.periodStarts[1]
+
+    ########################################
+    # Tariff
+    ######################
+    def _setupTariff(self):
+        self.tariff = None
+        if self.pluginPrefs.get("tariffEnabled", False):
+            try:
+                self.tariff = tariff.Tariff(self.pluginPrefs.get("tariffRules", ""))
+            except ValueError as e:
+                self.logger.warn(f"The tariff can not be used, no cost is counted: {e}")
+
+    def _addCost(self, dev, energy, start, ts, keyValueList):
+        cost = self._stateValue(dev, "accumCostTotal", 0) + self.tariff.cost(energy, start, ts)
+        rate = self.tariff.rate(ts)
+        keyValueList.append({'key': 'accumCostTotal', 'value': cost, 'uiValue': f"{cost:.2f}"})
+        keyValueList.append({'key': 'tariffRate', 'value': rate, 'uiValue': f"{rate:.4f}/kWh"})
+
+    def _rollOverPeriods(self):
+        # Meters drawing power roll over on their next refresh, idle ones need a zero
+        # settlement so their period states still start over at the boundary
+        ts = time.time()
+        if ts < self.periodRolloverTS:
+            return
+        self.periodRolloverTS = history.hourStart(ts) + 3600
+        for devId, periods in list(self.periodEnergy.items()):
+            if periods["hour"][0] != history.hourStart(ts) and not self.meterWatts.get(devId) \
+                    and devId in self.watchedIdsByMeterId:
+                self._addAccumEnergy(self._getDevice(devId), 0.0, ts)
 
     def runConcurrentThread(self):
+        with self.eventLock:
+            # Callbacks queue their events from here on, they are handled after the startup pass
+            startingDevices, self.startingDevices = self.startingDevices, None
+            self.workerRunning = True
+        self._finishStartup(startingDevices)
         try:
             while True:
-                for dev in indigo.devices.iter("self"):
-                    if not dev.enabled or not dev.configured:
-                        continue
-                    self._refreshState(dev)
-                self.sleep(int(self.pluginPrefs.get("deviceUpdate", 300)))
+                self._waitForWork(self._runLoopOnce())
+                if self.profiler is not None and self.profiler.done():
+                    self._finishProfile()
         except self.StopThread:
             pass  # Optionally catch the StopThread exception and do any needed cleanup.
+        finally:
+            with self.eventLock:
+                self.workerRunning = False
+                self._processEvents()
+                self._flushCoalesced()
+                self._flushStates(force=True)
+                self._syncJournal()
+            if self.profiler is not None:
+                self._finishProfile()
+
+    def _runLoopOnce(self):
+        # One pass of the concurrent thread, returns the number of seconds until it has work again
+        refreshInterval = int(self.pluginPrefs.get("deviceUpdate", 300))
+        self._processEvents()
+        if self.coalesceFlushTS and time.time() >= self.coalesceFlushTS:
+            self._flushCoalesced()
+        if self.pluginPrefs.get("refreshMode", "poll") == "event":
+            self._refreshDueMeters()
+            self._rollOverPeriods()
+            nextWakeTS = self.periodRolloverTS
+            if self.refreshQueue:
+                nextWakeTS = min(self.refreshQueue[0][0], nextWakeTS)
+        else:
+            if time.time() >= self.nextPollTS:
+                # Meters with their own refresh interval are left to _pollOwnIntervals
+                devs = [dev for dev in self._iterDevices("self")
+                        if dev.enabled and dev.configured and not self.refreshIntervals.get(dev.id)]
+                if self.pluginPrefs.get("batchRefresh", False):
+                    self._refreshStatesBatch([dev for dev in devs if dev.deviceTypeId == "virtualDeviceEnergyMeter"])
+                    devs = [dev for dev in devs if dev.deviceTypeId != "virtualDeviceEnergyMeter"]
+                for dev in devs:
+                    self._refreshState(dev)
+                self.nextPollTS = time.time() + refreshInterval
+            nextWakeTS = min(self.nextPollTS, self._pollOwnIntervals())
+        if self.instrumentation is not None and self.statsDeviceIds and time.time() - self.statisticsTS >= STATISTICS_INTERVAL:
+            self._publishStatistics()
+        if self.profiler is not None:
+            nextWakeTS = min(nextWakeTS, self.profiler.endTS)
+        if self.coalesceFlushTS:
+            # Anything written now goes out with the pending coalesced flush
+            nextWakeTS = min(nextWakeTS, self.coalesceFlushTS)
+        else:
+            self._flushStates()
+        self.logger.debug(f"{self.stateWrites} state updates sent to the server, {self.stateWritesAvoided} coalesced or held back, "
+                          f"{self.echoesDropped} of our own updates ignored")
+        if self.flushWrites:
+            self.logger.debug(f"Sent {self.flushWrites} state updates in {self.flushTime * 1000:.1f} ms since the last pass, "
+                              f"{self.flushWidth} at a time")
+            self.flushTime, self.flushWrites = 0.0, 0
+        self._compactHistory()
+        if time.time() - self.journalSyncTS >= JOURNAL_SYNC_INTERVAL:
+            self._syncJournal()
+        if self.heldStates and self.publishMaxAge:
+            nextWakeTS = min(nextWakeTS, self._heldStatesDueTS())
+        # Meters may have been settled up to now, events that arrived meanwhile count from here
+        self.eventFloorTS = time.time()
+        return min(max(nextWakeTS - time.time(), 0.01), refreshInterval)
+
+    def _waitForWork(self, seconds):
+        # Like self.sleep, but callbacks can wake the thread early when they have work for it
+        self.wakeEvent.wait(seconds)
+        self.wakeEvent.clear()
+        if self.stopThread:
+            raise self.StopThread()
+
+    ########################################
+    # Energy journal
+    ######################
+    def _openJournal(self):
+        # The last journaled state of every meter, it is resumed from when the meter starts
+        try:
+            self.journal = journal.Journal(os.path.join(self._dataFolder(), "journal"))
+        except OSError as e:
+            self.logger.warn(f"Could not open the energy journal, energy will not survive a crash: {e}")
+            return
+        self.resumeStates = dict(self.journal.latest)
+        for devId, (accumKwh, accumTS, watts) in self.resumeStates.items():
+            self.meterWatts[devId] = watts
+
+    def _resumeMeter(self, dev, ts):
+        # Anything the server lost in a crash comes back from the journal. The downtime is
+        # then settled at the power the meter last had, as meterWatts was seeded with it.
+        resumed = self.resumeStates.pop(dev.id, None)
+        if resumed is None or resumed[1] <= dev.states.get("accumEnergyTotalTS", 0):
+            return
+        accumKwh, accumTS, watts = resumed
+        accumTS = min(accumTS, ts)  # the clock may have been set back while we were down
+        self.logger.debug(f"Resuming {dev.name} from the journal at {accumKwh:.3f} kWh")
+        self._queueStates(dev, [{'key': 'accumEnergyTotal', 'value': accumKwh, 'uiValue': f"{accumKwh:.3f} kWh"},
+                                {'key': 'accumEnergyTotalTS', 'value': accumTS, 'uiValue': f"{accumTS}"}])
+
+    def _journalStates(self, pendingStates):
+        records = []
+        for devId, (dev, keyValues) in pendingStates.items():
+            if 'accumEnergyTotal' in keyValues:
+                accumTS = keyValues['accumEnergyTotalTS']['value'] if 'accumEnergyTotalTS' in keyValues \
+                    else dev.states.get("accumEnergyTotalTS", 0)
+                records.append((devId, keyValues['accumEnergyTotal']['value'], accumTS, self.meterWatts.get(devId, 0.0)))
+        try:
+            self.journal.append(records)
+        except OSError as e:
+            self._closeJournal(e)
+
+    def _syncJournal(self):
+        self.journalSyncTS = time.time()
+        if self.journal is not None:
+            try:
+                self.journal.sync()
+            except OSError as e:
+                self._closeJournal(e)
+
+    def _closeJournal(self, error):
+        self.logger.warn(f"Could not write the energy journal, energy will not survive a crash: {error}")
+        try:
+            self.journal.close()
+        except OSError:
+            pass
+        self.journal = None
+
+    ########################################
+    # Event queue
+    ######################
+    # Indigo callbacks only record what happened and when, the concurrent thread is the
+    # single owner of the meters and handles the events in the order they arrived.
+    # Before it starts and after it stops the callbacks handle their events themselves.
+    def _queueEvent(self, handler, ts, *args):
+        with self.eventLock:
+            if self.workerRunning or self.startingDevices is not None:
+                self.eventQueue.append((handler, ts, args))
+                self.wakeEvent.set()
+            else:
+                handler(ts, *args)
+
+    def _processEvents(self):
+        histogram = self.instrumentation.histogram("event queue wait") if self.instrumentation else None
+        while self.eventQueue:
+            handler, ts, args = self.eventQueue.popleft()
+            if histogram is not None:
+                histogram.add(time.time() - ts, time.perf_counter())
+            handler(max(ts, self.eventFloorTS), *args)
+
+    ########################################
+    # Event coalescing
+    ######################
+    def _readCoalesceWindow(self):
+        try:
+            self.coalesceWindow = max(float(self.pluginPrefs.get("coalesceWindow", 0)) / 1000, 0.0)
+        except ValueError:
+            self.coalesceWindow = 0.0
+
+    def _flushEventStates(self, ts):
+        if not self.workerRunning:
+            # Callbacks are handled right away once the concurrent thread has stopped,
+            # nothing would be left to flush after the window
+            self._flushCoalesced()
+        elif not self.coalesceWindow:
+            if not self.eventQueue:
+                self._flushStates()
+        elif not self.coalesceFlushTS and self.pendingStates:
+            self.coalesceFlushTS = ts + self.coalesceWindow
+            self.wakeEvent.set()
+
+    def _flushCoalesced(self):
+        # Groups see each deferred child change as its net delta now plus the energy the
+        # intermediate levels added since they happened, so their kWh stays exact
+        ts = time.time()
+        deferredDeltas, self.deferredDeltas = self.deferredDeltas, {}
+        self._propagateDeltas({devId: (delta, delta * ts - weightedTS)
+                               for devId, (delta, weightedTS) in deferredDeltas.items()}, ts)
+        self._flushStates()
+        self.coalesceFlushTS = 0
+
+    ########################################
+    # Energy history
+    ######################
+    def _dataFolder(self):
+        return os.path.join(indigo.server.getInstallFolderPath(), "Preferences", "Plugins", self.pluginId)
+
+    def _setupHistory(self):
+        if not self.pluginPrefs.get("historyEnabled", False):
+            self.history = None
+        elif self.history is None:
+            self.history = history.EnergyHistory(os.path.join(self._dataFolder(), "history"))
+            ts = time.time()
+            for devId, watts in self.meterWatts.items():
+                if devId in self.watchedIdsByMeterId:
+                    self.history.recordPower(devId, ts, watts)
+
+    def _compactHistory(self):
+        ts = time.time()
+        if self.history is None or ts - self.historyCompactedTS < 86400:
+            return
+        self.historyCompactedTS = ts
+        self.history.compact(ts - int(self.pluginPrefs.get("historyRawDays", 7)) * 86400,
+                             ts - int(self.pluginPrefs.get("historyHourlyDays", 400)) * 86400)
+
+    def _parseLocalTime(self, text):
+        for timeFormat in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+            try:
+                return time.mktime(time.strptime(text.strip(), timeFormat))
+            except ValueError:
+                pass
+        raise ValueError(f"Can not parse time {text}")
+
+    def logEnergyUsage(self, valuesDict, typeId):
+        dev = self._getDevice(int(valuesDict["meterId"]))
+        energy = self.history.energyBetween(dev.id, self._parseLocalTime(valuesDict["start"]), self._parseLocalTime(valuesDict["end"]))
+        indigo.server.log(f"{dev.name} used {energy:.3f} kWh from {valuesDict['start']} to {valuesDict['end']}")
+        return True
+
+    ########################################
+    # Event log replay
+    ######################
+    def replayEventLog(self, valuesDict, typeId):
+        import replay  # needs numpy, only loaded when a log is replayed
+        startedTS = time.perf_counter()
+        log = replay.EventLog(replay.loadEvents(valuesDict["eventLogPath"].strip()))
+        devs = [self._getDevice(int(meterId)) for meterId in valuesDict.get("meterIds", [])]
+        start = self._parseLocalTime(valuesDict["start"]) if valuesDict.get("start", "").strip() else log.firstTS()
+        end = self._parseLocalTime(valuesDict["end"]) if valuesDict.get("end", "").strip() else time.time()
+        # The curves are compiled from the meters' current configuration
+        meters = {dev.id: (int(dev.ownerProps["parentDeviceId"]),
+                           self._compilePowerCurve(dev.ownerProps) if dev.ownerProps.get("parentDeviceDimmer")
+                           else float(dev.ownerProps["powerAtOn"]))
+                  for dev in devs}
+        energy = replay.replay(log, meters, start, end)
+        indigo.server.log(f"Replayed {len(log)} events for {len(devs)} meters in {(time.perf_counter() - startedTS) * 1000:.0f} ms")
+        for dev in devs:
+            indigo.server.log(f"{dev.name} used {energy[dev.id]:.3f} kWh, its total is {dev.states.get('accumEnergyTotal', 0):.3f} kWh")
+        if valuesDict.get("rewriteEnergy", False):
+            self._queueEvent(self._rewriteEnergy, time.time(), devs, energy, end)
+        return True
+
+    def _rewriteEnergy(self, ts, devs, energy, end):
+        # The replayed energy up to end replaces the meters' totals, they count on from there
+        for dev in devs:
+            self._queueStates(dev, [{'key': 'accumEnergyTotal', 'value': energy[dev.id], 'uiValue': f"{energy[dev.id]:.3f} kWh"},
+                                    {'key': 'accumEnergyTotalTS', 'value': end, 'uiValue': f"{end}"}])
+            indigo.server.log(f"{dev.name} total energy set to {energy[dev.id]:.3f} kWh")
+        self._flushStates(force=True)
+
+    ########################################
+    # Refresh scheduler
+    ######################
+    def _scheduleRefresh(self, devId, ts):
+        # Only meters drawing power need a periodic refresh, everything else is
+        # settled exactly when its parent or children change
+        if devId not in self.refreshDue:
+            due = ts + self._refreshInterval(devId)
+            self.refreshDue[devId] = due
+            heapq.heappush(self.refreshQueue, (due, devId))
+
+    def _refreshInterval(self, devId):
+        return self.refreshIntervals.get(devId) or int(self.pluginPrefs.get("deviceUpdate", 300))
+
+    def _readRefreshInterval(self, dev, ts):
+        # A meter's own interval replaces the plugin's polling time, empty means use that
+        try:
+            refreshInterval = int(dev.ownerProps.get("refreshInterval") or 0)
+        except ValueError:
+            refreshInterval = 0
+        if refreshInterval != self.refreshIntervals.get(dev.id, 0):
+            self.refreshIntervals[dev.id] = refreshInterval
+            self.pollDue.pop(dev.id, None)
+            if self.refreshDue.pop(dev.id, None) is not None:
+                self._scheduleRefresh(dev.id, ts)
+
+    def _pollOwnIntervals(self):
+        # Poll mode refreshes meters with their own interval on their own schedule,
+        # returns when the next one is due
+        now = time.time()
+        nextDueTS = float("inf")
+        for devId, refreshInterval in list(self.refreshIntervals.items()):
+            if not refreshInterval:
+                continue
+            due = self.pollDue.get(devId)
+            if due is None:
+                due = self.pollDue[devId] = now + refreshInterval
+            elif due <= now:
+                self._refreshState(self._getDevice(devId))
+                due = self.pollDue[devId] = now + refreshInterval
+            nextDueTS = min(nextDueTS, due)
+        return nextDueTS
+
+    def _refreshDueMeters(self):
+        now = time.time()
+        while self.refreshQueue and self.refreshQueue[0][0] <= now:
+            due, devId = heapq.heappop(self.refreshQueue)
+            if self.refreshDue.get(devId) != due:
+                continue
+            del self.refreshDue[devId]
+            if self.meterWatts.get(devId) and devId in self.watchedIdsByMeterId:
+                self._refreshState(self._getDevice(devId))
+
+    def _refreshStatesBatch(self, devs, ts=None):
+        ts = time.time() if ts is None else ts
+        meters = []
+        parentStates = []
+        parentStatesById = {}
+        for dev in devs:
+            if "curEnergyLevel" not in dev.states:
+                continue
+            parentId = int(dev.ownerProps["parentDeviceId"])
+            if parentId not in parentStatesById:
+                parentStatesById[parentId] = self._watchedStates(parentId)
+            if parentStatesById[parentId] is None:
+                self.logger.warn("Parent device  does not exist any more")
+                continue
+            meters.append(dev)
+            parentStates.append(parentStatesById[parentId])
+        if not meters:
+            return
+
+        import numpy as np  # only needed here and slow to import, so it is not loaded for every plugin launch
+        isDimmer = np.array(["brightnessLevel" in states for states in parentStates])
+        rows, curves, powerAtOn = self._curveStack(np, meters, isDimmer)
+        isOn = np.array([bool(states['onOffState']) for states in parentStates])
+        levels = np.clip(np.array([int(states.get("brightnessLevel", 0)) for states in parentStates]), 0, 100)
+        accumTS = np.array([self._stateValue(dev, "accumEnergyTotalTS", ts) or ts for dev in meters], dtype=float)
+
+        watts = np.where(isOn, np.where(isDimmer, curves[rows, levels], powerAtOn[rows]), 0.0)
+        meterWatts = self.meterWatts
+        settledWatts = np.array([meterWatts.get(dev.id, np.nan) for dev in meters], dtype=float)
+        settledWatts = np.where(np.isnan(settledWatts), watts, settledWatts)
+        energies = ((ts - accumTS) / 3600 * settledWatts) / 1000
+        wattsStrs = np.char.add(np.char.mod("%.2f", watts), " W").tolist()
+
+        for dev, devWatts, wattsStr, energy in zip(meters, watts.tolist(), wattsStrs, energies.tolist()):
+            self._addAccumEnergy(dev, energy, ts)
+            self._queueStates(dev, [{'key': 'curEnergyLevel', 'value': devWatts, 'uiValue': wattsStr}])
+            self._applyWattsChange(dev.id, devWatts, ts)
+
+    def _curveStack(self, np, meters, isDimmer):
+        # Every meter's power curve as a row of one array, made again only when a curve
+        # changes or a meter is not in it yet. Meters of relays have their power at on instead.
+        stack = self.curveStack
+        if stack is not None:
+            rowsById, curves, powerAtOn, stackedDimmer = stack
+            rows = np.array([rowsById.get(dev.id, -1) for dev in meters])
+            if rows.min() >= 0 and np.array_equal(stackedDimmer[rows], isDimmer):
+                return rows, curves, powerAtOn
+        rowsById = {dev.id: row for row, dev in enumerate(meters)}
+        curves = np.array([self._powerCurve(dev) if dimmer else [0.0] * 101 for dev, dimmer in zip(meters, isDimmer)])
+        powerAtOn = np.array([0.0 if dimmer else float(dev.ownerProps["powerAtOn"]) for dev, dimmer in zip(meters, isDimmer)])
+        self.curveStack = (rowsById, curves, powerAtOn, isDimmer)
+        return np.arange(len(meters)), curves, powerAtOn
 
     def logWatchedDevices(self):
-        for devId in self.parentDevIdsWeUseDict:
-            indigo.server.log(f"{indigo.devices[devId].name}({devId})")
+        for devId in sorted(self.meterIdsByParentId.keys() | self.groupIdsByChildId.keys()):
+            indigo.server.log(f"{self._getDevice(devId).name}({devId})")
+
+    ########################################
+    # Instrumentation
+    ######################
+    def _setupInstrumentation(self):
+        if self.pluginPrefs.get("instrumentationEnabled", False):
+            if self.instrumentation is None:
+                self.instrumentation = stats.Instrumentation()
+                self.instrumentation.wrap(self, INSTRUMENTED_METHODS)
+        elif self.instrumentation is not None:
+            self.instrumentation.unwrap(self)
+            self.instrumentation = None
+
+    def _getDevice(self, devId):
+        return indigo.devices[devId]
+
+    def _deviceExists(self, devId):
+        return devId in indigo.devices
+
+    def _iterDevices(self, filter=""):
+        # A list, so the walk is timed as a whole and not just its start
+        return list(indigo.devices.iter(filter))
+
+    def logStatistics(self):
+        if self.instrumentation is None:
+            indigo.server.log("Instrumentation is off, turn it on in the plugin configuration")
+            return
+        uptime = time.time() - self.instrumentation.startTS
+        indigo.server.log(f"Statistics for the last {uptime / 60:.0f} minutes, times in ms (p50/p95/p99 over the last 5-10 minutes)")
+        for name, calls, p50, p95, p99, last in sorted(self.instrumentation.summary()):
+            indigo.server.log(f"{name:<16} {calls:>9} calls  p50 {p50:8.3f}  p95 {p95:8.3f}  p99 {p99:8.3f}  last {last:8.3f}")
+        indigo.server.log(f"{self.stateWrites} state updates sent to the server, {self.stateWritesAvoided} coalesced or held back, "
+                          f"{self.echoesDropped} of our own updates ignored")
+        if self.flushPool is not None:
+            indigo.server.log(f"State updates are sent {self.flushWidth} at a time (at most {self.flushThreads})")
+
+    def profilePlugin(self, valuesDict, typeId):
+        seconds, maxCalls = float(valuesDict.get("seconds", 60)), int(valuesDict.get("maxCalls", 100000))
+        self._queueEvent(self._startProfile, time.time(), seconds, maxCalls)
+        indigo.server.log(f"Profiling the plugin for {seconds:.0f} seconds or {maxCalls} calls, whichever comes first")
+        return True
+
+    def _startProfile(self, ts, seconds, maxCalls):
+        if self.profiler is not None:
+            self._finishProfile()
+        self.profiler = stats.Profiler(seconds, maxCalls, self.wakeEvent.set)
+        self.profiler.wrap(self, PROFILED_METHODS)
+
+    def _finishProfile(self):
+        profiler, self.profiler = self.profiler, None
+        profileStats = profiler.stop(self)
+        if profileStats is None:
+            indigo.server.log("Nothing was profiled, the plugin had no work while profiling")
+            return
+        indigo.server.log(f"Profile of {profiler.calls} calls over {time.time() - profiler.startTS:.0f} seconds, "
+                          f"the functions that took the most time themselves:")
+        for line in stats.hotspots(profileStats):
+            indigo.server.log(line)
+        path = os.path.join(self._dataFolder(), f"profile-{time.strftime('%Y%m%d-%H%M%S')}.pstats")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            dropped = stats.dumpStats(profileStats, path, PROFILE_MAX_BYTES)
+        except OSError as e:
+            self.logger.warn(f"Could not save the profile to {path}: {e}")
+            return
+        if dropped:
+            indigo.server.log(f"The profile was too large, {dropped} functions that took the least time were left out")
+        indigo.server.log(f"Saved the profile to {path}, open it with python3 -m pstats")
+
+    def _publishStatistics(self):
+        self.statisticsTS = time.time()
+        keyValueList = []
+        for name, calls, p50, p95, p99, last in self.instrumentation.summary():
+            state = STATISTICS_STATES.get(name)
+            if state is not None:
+                keyValueList.append({'key': f"{state}Calls", 'value': calls})
+                keyValueList.append({'key': f"{state}P95", 'value': round(p95, 3), 'uiValue': f"{p95:.3f} ms"})
+        keyValueList.append({'key': "stateWrites", 'value': self.stateWrites})
+        for devId in self.statsDeviceIds:
+            self._queueStates(self._getDevice(devId), keyValueList)
+
+    ########################################
+    # State write buffer
+    ######################
+    def _queueStates(self, dev, keyValueList):
+        if not keyValueList:
+            return
+        pending = self.pendingStates.get(dev.id)
+        if pending is None:
+            pending = self.pendingStates[dev.id] = (dev, {})
+        else:
+            self.stateWritesAvoided += 1
+        for keyValue in keyValueList:
+            pending[1][keyValue['key']] = keyValue
+
+    def _stateValue(self, dev, key, default=None):
+        for states in (self.pendingStates, self.heldStates):
+            pending = states.get(dev.id)
+            if pending is not None and key in pending[1]:
+                return pending[1][key]['value']
+        return dev.states.get(key, default)
+
+    def _flushStates(self, force=False):
+        pendingStates, self.pendingStates = self.pendingStates, {}
+        if self.journal is not None and pendingStates:
+            self._journalStates(pendingStates)
+        ts = time.time()
+        if self.metrics is not None:
+            self._updateMetrics(pendingStates, ts)
+        writes = []
+        for devId, (dev, keyValues) in pendingStates.items():
+            held = self.heldStates.pop(devId, None)
+            if held is not None:
+                held[1].update(keyValues)
+                keyValues = held[1]
+            if force or self._shouldPublish(devId, keyValues, ts):
+                writes.append(self._publishStates(dev, keyValues, ts))
+            else:
+                self.heldStates[devId] = (dev, keyValues)
+                self.stateWritesAvoided += 1
+        if self.heldStates and (force or ts - self.heldCheckTS >= 1):
+            writes.extend(self._publishStaleStates(ts, force))
+        if writes:
+            self._sendStates(writes)
+
+    def _publishStates(self, dev, keyValues, ts):
+        # Returns the write, a device is written at most once per flush
+        self.stateWrites += 1
+        if self.publishMinWatts or self.publishMinKwh:
+            published = self.publishedStates.get(dev.id, (0, None, None))
+            self.publishedStates[dev.id] = (ts, keyValues['curEnergyLevel']['value'] if 'curEnergyLevel' in keyValues else published[1],
+                                            keyValues['accumEnergyTotal']['value'] if 'accumEnergyTotal' in keyValues else published[2])
+        return dev, list(keyValues.values())
+
+    ########################################
+    # Metrics endpoint
+    ######################
+    # The readings come from the states the plugin queues, held back ones included, so the
+    # endpoint is as current as the plugin and costs the Indigo server nothing
+    def _setupMetrics(self):
+        address = (self.pluginPrefs.get("metricsAddress", "127.0.0.1") or "127.0.0.1",
+                   int(self.pluginPrefs.get("metricsPort", 9180) or 9180))
+        if self.metrics is not None and (not self.pluginPrefs.get("metricsEnabled", False) or self.metrics.address != address):
+            self.metrics.close()
+            self.metrics = None
+        if self.pluginPrefs.get("metricsEnabled", False) and self.metrics is None:
+            try:
+                self.metrics = metrics.MetricsServer(address[0], address[1], self.logger)
+            except OSError as e:
+                self.logger.error(f"Could not start the metrics endpoint on {address[0]}:{address[1]}: {e}")
+                return
+            self.logger.info(f"Serving meter readings on http://{address[0]}:{address[1]}/metrics")
+            if self.startingDevices is None:
+                # Enabled while running, the meters started at startup are not seen again
+                for dev in self._iterDevices("self"):
+                    self._trackMetrics(dev)
+
+    def _trackMetrics(self, dev):
+        if self.metrics is not None and dev.deviceTypeId != "pluginStatistics":
+            self.metrics.update(dev.id, dev.name, dev.deviceTypeId, self._stateValue(dev, "curEnergyLevel", 0.0),
+                                self._stateValue(dev, "accumEnergyTotal", 0.0), self._stateValue(dev, "accumEnergyTotalTS", 0))
+
+    def _updateMetrics(self, pendingStates, ts):
+        for devId, (dev, keyValues) in pendingStates.items():
+            watts, kwh = keyValues.get('curEnergyLevel'), keyValues.get('accumEnergyTotal')
+            if (watts is not None or kwh is not None) and devId not in self.statsDeviceIds:
+                self.metrics.update(devId, dev.name, dev.deviceTypeId, watts and watts['value'], kwh and kwh['value'], ts)
+
+    ########################################
+    # Concurrent state writes
+    ######################
+    # Every updateStatesOnServer call is a round trip to the server, with flushThreads above 1
+    # large flushes are spread over a pool of threads. A flush returns when all its writes are
+    # done, so the writes of a device still reach the server in order. The number of threads
+    # used is halved when a write takes more than twice as long as the fastest seen lately
+    # (the server is busy) and grows back by one per flush when it does not.
+    def _setupFlushPool(self):
+        try:
+            flushThreads = min(max(int(self.pluginPrefs.get("flushThreads", 1)), 1), 32)
+        except ValueError:
+            flushThreads = 1
+        if flushThreads != self.flushThreads or (flushThreads > 1) != (self.flushPool is not None):
+            if self.flushPool is not None:
+                self.flushPool.shutdown()
+            self.flushPool = concurrent.futures.ThreadPoolExecutor(flushThreads, "stateFlush") if flushThreads > 1 else None
+            self.flushThreads = self.flushWidth = flushThreads
+            self.flushLatency = None
+
+    def _sendStates(self, writes):
+        startTS = time.perf_counter()
+        width = self.flushWidth
+        if self.flushPool is None or len(writes) < width * FLUSH_POOL_MIN_WRITES:
+            for dev, keyValueList in writes:
+                dev.updateStatesOnServer(keyValueList)
+        else:
+            futures = [self.flushPool.submit(self._sendChunk, writes[i::width]) for i in range(width)]
+            for future in futures:
+                for dev, e in future.result():
+                    self.logger.warn(f"Could not update the states of {dev.name}: {e}")
+            self._adjustFlushWidth((time.perf_counter() - startTS) * width / len(writes))
+        self.flushTime += time.perf_counter() - startTS
+        self.flushWrites += len(writes)
+
+    def _sendChunk(self, writes):
+        failed = []
+        for dev, keyValueList in writes:
+            try:
+                dev.updateStatesOnServer(keyValueList)
+            except Exception as e:
+                failed.append((dev, e))
+        return failed
+
+    def _adjustFlushWidth(self, latency):
+        # latency is the average time of one write as seen by a thread
+        if self.flushLatency is None or latency < self.flushLatency:
+            self.flushLatency = latency
+        else:
+            self.flushLatency *= 1.05  # let the baseline follow a server that got slower for good
+        if latency > 2 * self.flushLatency and self.flushWidth > 1:
+            self.flushWidth = max(self.flushWidth // 2, 1)
+        elif self.flushWidth < self.flushThreads:
+            self.flushWidth += 1
+
+    ########################################
+    # Publish thresholds
+    ######################
+    # Small changes in power or energy can be held back, they are sent with the next change
+    # that is big enough or once they are publishMaxAge seconds old
+    def _readPublishThresholds(self):
+        try:
+            self.publishMinWatts = max(float(self.pluginPrefs.get("publishMinWatts", 0)), 0.0)
+            self.publishMinKwh = max(float(self.pluginPrefs.get("publishMinKwh", 0)), 0.0)
+            self.publishMaxAge = max(float(self.pluginPrefs.get("publishMaxAge", 0)), 0.0)
+        except ValueError:
+            self.publishMinWatts = self.publishMinKwh = self.publishMaxAge = 0.0
+        self.publishedStates = {}
+
+    def _shouldPublish(self, devId, keyValues, ts):
+        if not (self.publishMinWatts or self.publishMinKwh) \
+                or ('curEnergyLevel' not in keyValues and 'accumEnergyTotal' not in keyValues):
+            return True
+        published = self.publishedStates.get(devId)
+        if published is None or (self.publishMaxAge and ts - published[0] >= self.publishMaxAge):
+            return True
+        publishedTS, watts, kwh = published
+        if 'curEnergyLevel' in keyValues and (watts is None or abs(keyValues['curEnergyLevel']['value'] - watts)
+                                              >= max(self.publishMinWatts, 1e-9)):
+            return True
+        if 'accumEnergyTotal' in keyValues and (kwh is None or abs(keyValues['accumEnergyTotal']['value'] - kwh)
+                                                >= max(self.publishMinKwh, 1e-12)):
+            return True
+        return False
+
+    def _heldStatesDueTS(self):
+        # When the oldest held back states reach the maximum age, held states are looked at
+        # at most once a second
+        oldestTS = min(self.publishedStates[devId][0] if devId in self.publishedStates else 0 for devId in self.heldStates)
+        return max(oldestTS + self.publishMaxAge, self.heldCheckTS + 1)
+
+    def _publishStaleStates(self, ts, force=False):
+        self.heldCheckTS = ts
+        force = force or not (self.publishMinWatts or self.publishMinKwh)
+        writes = []
+        for devId, (dev, keyValues) in list(self.heldStates.items()):
+            published = self.publishedStates.get(devId)
+            if force or published is None or (self.publishMaxAge and ts - published[0] >= self.publishMaxAge):
+                del self.heldStates[devId]
+                writes.append(self._publishStates(dev, keyValues, ts))
+        return writes
+
+    ########################################
+    # Watched device index
+    ######################
+    def _indexMeter(self, dev):
+        self._unindexMeter(dev.id)
+        watchedIds = set()
+        if dev.deviceTypeId == "virtualDeviceEnergyMeter":
+            if not self._deviceExists(int(dev.ownerProps["parentDeviceId"])):
+                self.logger.warn(f"Parent device does not exist any more for device {dev.name}")
+            else:
+                watchedIds.add(int(dev.ownerProps["parentDeviceId"]))
+            index = self.meterIdsByParentId
+        elif dev.deviceTypeId == "virtualGroupEnergyMeter":
+            for devId in dev.ownerProps.get("childEnergyMeters", []):
+                if not self._deviceExists(int(devId)):
+                    self.logger.warn(f"Child device {devId} does not exist any more for device {dev.name}")
+                else:
+                    watchedIds.add(int(devId))
+            index = self.groupIdsByChildId
+        elif dev.deviceTypeId == "virtualFormulaEnergyMeter":
+            try:
+                compiled = self._compileFormula(dev.ownerProps)
+            except ValueError as e:
+                self.logger.warn(f"The formula of {dev.name} can not be used: {e}")
+                return
+            for devId in compiled[2]:
+                if not self._deviceExists(devId):
+                    self.logger.warn(f"Input device {devId} does not exist any more for device {dev.name}")
+                else:
+                    watchedIds.add(devId)
+            self.formulas[dev.id] = compiled
+            index = self.meterIdsByParentId
+        else:
+            return
+        for watchedId in watchedIds:
+            index.setdefault(watchedId, set()).add(dev.id)
+        self.watchedIdsByMeterId[dev.id] = watchedIds
+        if dev.id in self.formulas:
+            self._updateMirrorKeys(watchedIds)
+        self._readRefreshInterval(dev, time.time())
+
+    def _unindexMeter(self, devId):
+        self.meterRanks = {}
+        self.periodEnergy.pop(devId, None)
+        self.refreshDue.pop(devId, None)
+        self._dropPowerCurve(devId)
+        self.groupWatts.pop(devId, None)
+        self.refreshIntervals.pop(devId, None)
+        self.pollDue.pop(devId, None)
+        self.formulaWatts.pop(devId, None)
+        wasFormula = self.formulas.pop(devId, None) is not None
+        watchedIds = self.watchedIdsByMeterId.pop(devId, ())
+        for watchedId in watchedIds:
+            for index in (self.meterIdsByParentId, self.groupIdsByChildId):
+                meterIds = index.get(watchedId)
+                if meterIds is not None:
+                    meterIds.discard(devId)
+                    if not meterIds:
+                        del index[watchedId]
+            if watchedId not in self.meterIdsByParentId and watchedId not in self.groupIdsByChildId:
+                self.stateMirror.pop(watchedId, None)
+        if wasFormula:
+            self._updateMirrorKeys(watchedIds)
+
+    def _unindexWatchedDevice(self, devId):
+        self.meterRanks = {}
+        self.stateMirror.pop(devId, None)
+        self.mirrorKeys.pop(devId, None)
+        for index in (self.meterIdsByParentId, self.groupIdsByChildId):
+            for meterId in index.pop(devId, ()):
+                self.watchedIdsByMeterId.get(meterId, set()).discard(devId)
+
+    ########################################
+    # Watched device state mirror
+    ######################
+    # Every change of a watched device reaches deviceUpdated, so the states we need are
+    # kept here instead of fetching the device from the server on every refresh. Entries
+    # older than MIRROR_MAX_AGE are fetched again, in case a notification was missed.
+    def _watchedStates(self, devId):
+        mirrored = self.stateMirror.get(devId)
+        if mirrored is not None and time.time() - mirrored[0] < MIRROR_MAX_AGE:
+            return mirrored[1]
+        if not self._deviceExists(devId):
+            self.stateMirror.pop(devId, None)
+            return None
+        return self._mirrorStates(self._getDevice(devId))
+
+    def _mirrorStates(self, dev):
+        states = {key: dev.states[key] for key in MIRRORED_STATES if key in dev.states}
+        for key in self.mirrorKeys.get(dev.id, ()):
+            if key in dev.states:
+                states[key] = dev.states[key]
+        self.stateMirror[dev.id] = (time.time(), states)
+        return states
+
+    def _updateMirrorKeys(self, devIds):
+        # Formula meters can use any state, those are mirrored on top of MIRRORED_STATES
+        for devId in devIds:
+            keys = set()
+            for meterId in self.meterIdsByParentId.get(devId, ()):
+                if meterId in self.formulas:
+                    keys.update(self.formulas[meterId][2].get(devId, ()))
+            if keys:
+                self.mirrorKeys[devId] = keys
+            else:
+                self.mirrorKeys.pop(devId, None)
+            mirrored = self.stateMirror.get(devId)
+            if mirrored is not None and not keys <= mirrored[1].keys():
+                del self.stateMirror[devId]
+
+    ########################################
+    # Formula meters
+    ######################
+    # The formula is compiled when the meter starts or its configuration changes, and its
+    # power is kept until one of the states it uses changes
+    def _parseFormulaInputs(self, text):
+        inputIds = {}
+        for entry in text.replace("\n", ",").split(","):
+            if entry.strip():
+                alias, devId = entry.split("=")
+                alias = alias.strip()
+                if not alias.isidentifier():
+                    raise ValueError(f"{alias} is not a valid alias")
+                inputIds[alias] = int(devId)
+        return inputIds
+
+    def _compileFormula(self, props):
+        # (formula, device id by alias, states used by device id)
+        inputIds = self._parseFormulaInputs(props.get("formulaInputs", ""))
+        compiled = formula.Formula(props.get("formula", ""))
+        unknown = compiled.aliases() - inputIds.keys()
+        if unknown:
+            raise formula.FormulaError(f"No input is called {', '.join(sorted(unknown))}")
+        statesById = {}
+        for alias, state in compiled.inputs:
+            statesById.setdefault(inputIds[alias], set()).add(state)
+        return compiled, inputIds, statesById
+
+    def _formulaPower(self, dev):
+        watts = self.formulaWatts.get(dev.id)
+        if watts is not None:
+            return watts
+        compiled = self.formulas.get(dev.id)
+        if compiled is None:
+            try:
+                compiled = self._compileFormula(dev.ownerProps)
+            except ValueError as e:
+                self.logger.warn(f"The formula of {dev.name} can not be used: {e}")
+                return None
+        compiledFormula, inputIds, statesById = compiled
+        states = {}
+        for alias in compiledFormula.aliases():
+            states[alias] = self._watchedStates(inputIds[alias])
+            if states[alias] is None:
+                self.logger.warn(f"Input device {alias} of {dev.name} does not exist any more")
+                return 0.0
+        try:
+            watts = float(compiledFormula(states))
+        except (ArithmeticError, TypeError, ValueError) as e:
+            self.logger.warn(f"The formula of {dev.name} failed: {e}")
+            watts = 0.0
+        if dev.id in self.formulas:
+            self.formulaWatts[dev.id] = watts
+        return watts
+
+    def _formulaInputChanged(self, meterId, origDev, newDev):
+        return any(origDev.states.get(key) != newDev.states.get(key)
+                   for key in self.formulas[meterId][2].get(newDev.id, ()))
+
+    ########################################
+    # Group aggregation
+    ######################
+    def _meterRank(self, devId, visiting=frozenset()):
+        # Groups always rank above their children, so propagating in rank order settles
+        # every child before the groups that contain it. Cycles are rejected on save.
+        rank = self.meterRanks.get(devId)
+        if rank is None:
+            rank = 0
+            visiting = visiting | {devId}
+            for watchedId in self.watchedIdsByMeterId.get(devId, ()):
+                if watchedId in self.watchedIdsByMeterId and watchedId not in visiting:
+                    rank = max(rank, self._meterRank(watchedId, visiting) + 1)
+            self.meterRanks[devId] = rank
+        return rank
+
+    def _lastKnownWatts(self, devId):
+        if devId not in self.meterWatts:
+            states = self._watchedStates(devId)
+            self.meterWatts[devId] = states.get('curEnergyLevel', 0) if states is not None else 0
+        return self.meterWatts[devId]
+
+    def _settleGroup(self, dev, ts, keyValueList, extraWattSeconds=0.0):
+        if dev.id not in self.groupWatts:
+            self.groupWatts[dev.id] = sum(self._lastKnownWatts(childId) for childId in self.watchedIdsByMeterId.get(dev.id, ()))
+        watts = self.groupWatts[dev.id]
+        if abs(watts) < 1e-9:
+            watts = self.groupWatts[dev.id] = 0.0
+        if self.groupFromChildEnergy:
+            # The children already added their energy
+            energy = 0.0
+        else:
+            settledWatts = self.meterWatts.get(dev.id, self._stateValue(dev, 'curEnergyLevel', 0))
+            accumEnergyTotalTS = self._stateValue(dev, "accumEnergyTotalTS", ts)
+            if accumEnergyTotalTS == 0:
+                accumEnergyTotalTS = ts
+            energy = ((ts - accumEnergyTotalTS) / 3600 * settledWatts + extraWattSeconds / 3600) / 1000
+        self._addAccumEnergy(dev, energy, ts)
+        keyValueList.append(
+            {'key': 'curEnergyLevel', 'value': watts, 'uiValue': f"{watts:.2f} W"})
+        return watts
+
+    def _applyWattsChange(self, devId, watts, ts):
+        delta = self._setMeterWatts(devId, watts, ts)
+        if not delta or self.groupWattsHeld or devId not in self.groupIdsByChildId:
+            return
+        if self.coalesceWindow:
+            deferred = self.deferredDeltas.setdefault(devId, [0.0, 0.0])
+            deferred[0] += delta
+            deferred[1] += delta * ts
+            return
+        self._propagateDeltas({devId: (delta, 0.0)}, ts)
+
+    def _setMeterWatts(self, devId, watts, ts):
+        delta = watts - self.meterWatts.get(devId, 0.0)
+        self.meterWatts[devId] = watts
+        if devId in self.watchedIdsByMeterId:
+            if watts:
+                self._scheduleRefresh(devId, ts)
+            if self.history is not None:
+                self.history.recordPower(devId, ts, watts)
+        return delta
+
+    def _propagateDeltas(self, changes, ts):
+        # changes maps a child id to its (watts delta, extra watt seconds) for its groups
+        deltas = {}
+        queue = []
+        for devId, change in changes.items():
+            self._queueGroupDeltas(devId, change, deltas, queue)
+        while queue:
+            groupId = heapq.heappop(queue)[1]
+            delta, extraWattSeconds = deltas.pop(groupId)
+            if groupId in self.groupWatts:
+                self.groupWatts[groupId] += delta
+            groupDev = self._getDevice(groupId)
+            self.logger.debug(f"Child device has change, update Group Energy Meter {groupDev.name}")
+            keyValueList = []
+            groupWatts = self._settleGroup(groupDev, ts, keyValueList, extraWattSeconds)
+            self._queueStates(groupDev, keyValueList)
+            self._queueGroupDeltas(groupId, (self._setMeterWatts(groupId, groupWatts, ts), extraWattSeconds), deltas, queue)
+
+    def _queueGroupDeltas(self, devId, change, deltas, queue):
+        if not any(change):
+            return
+        for groupId in self.groupIdsByChildId.get(devId, ()):
+            if groupId not in deltas:
+                deltas[groupId] = [0.0, 0.0]
+                heapq.heappush(queue, (self._meterRank(groupId), groupId))
+            deltas[groupId][0] += change[0]
+            deltas[groupId][1] += change[1]
+
+    ########################################
+    # Group energy from child energy
+    ######################
+    # With groupAccumulation set to childEnergy a group's kWh is the sum of the energy its
+    # children added while they were in it, instead of its power integrated over time.
+    # Resetting a child leaves its groups alone, a deleted child is settled up to its deletion.
+    def _readGroupAccumulation(self):
+        self.groupFromChildEnergy = self.pluginPrefs.get("groupAccumulation", "power") == "childEnergy"
+
+    def _addChildEnergy(self, childId, energy, ts, start=None):
+        for groupId in self.groupIdsByChildId.get(childId, ()):
+            pending = self.pendingStates.get(groupId)
+            self._addAccumEnergy(pending[0] if pending is not None else self._getDevice(groupId), energy, ts, start=start)
+
+    def _childEnergyChanged(self, origDev, newDev, ts):
+        # Energy meters of other plugins, their kWh only going down means they were reset
+        energy = newDev.states["accumEnergyTotal"] - (origDev.states.get("accumEnergyTotal") or 0)
+        if energy < 0:
+            energy = newDev.states["accumEnergyTotal"]
+        if energy:
+            self._addChildEnergy(newDev.id, energy, ts)
+
+    def _groupContainsItself(self, groupId, childIds):
+        groupChildIds = {dev.id: dev.ownerProps.get("childEnergyMeters", [])
+                         for dev in self._iterDevices("self") if dev.deviceTypeId == "virtualGroupEnergyMeter"}
+        groupChildIds[groupId] = childIds
+        stack = [int(childId) for childId in childIds]
+        seen = set()
+        while stack:
+            childId = stack.pop()
+            if childId == groupId:
+                return True
+            if childId not in seen:
+                seen.add(childId)
+                stack.extend(int(x) for x in groupChildIds.get(childId, []))
+        return False
 
     ########################################
     # Device Creation Callbacks
     ######################
     def getDeviceList(self, filter="supportsOnState", valuesDict=None, typeId="", targetId=0):
-        # A little bit of Python list comprehension magic here. Basically, it iterates through
-        # the device list and only adds the device if it has the filter property and is enabled.
-        return [(dev.id, dev.name) for dev in indigo.devices if hasattr(dev, filter)]
+        # Devices that have the filter attribute
+        if filter not in self.pickerAttributes:
+            self._pickerEntries()
+            for dev in self._iterDevices():
+                if hasattr(dev, filter):
+                    self._setPickerEntry(dev, extraList=f"attr:{filter}")
+            self.pickerAttributes.add(filter)
+        return self._pickerList(f"attr:{filter}")
 
     def devicesThatSupportOnState(self, filter="", valuesDict=None, typeId="", targetId=0):
-        menuItems = []
-        for dev in indigo.devices.iter("indigo.relay, indigo.dimmer"):
-            menuItems.append((dev.id, dev.name))
-        for dev in indigo.devices.iter("indigo.sensor, props.SupportsOnState"):
-            menuItems.append((dev.id, dev.name))
-        return menuItems
+        return self._pickerList("onState")
+
+    def devicesThatSupportEnergyMeter(self, filter="", valuesDict=None, typeId="", targetId=0):
+        return self._pickerList("energyMeters")
 
     def parentDeviceIdChanged(self, valuesDict, typeId, devId):
         if typeId == "virtualDeviceEnergyMeter":
-            dev = indigo.devices[int(valuesDict["parentDeviceId"])]
-            if "brightnessLevel" in dev.states:
-                valuesDict["parentDeviceDimmer"] = True
+            entry = self._pickerEntries().get(int(valuesDict["parentDeviceId"]))
+            if entry is not None:
+                valuesDict["parentDeviceDimmer"] = entry[2]
             else:
-                valuesDict["parentDeviceDimmer"] = False
+                valuesDict["parentDeviceDimmer"] = "brightnessLevel" in self._getDevice(int(valuesDict["parentDeviceId"])).states
         return valuesDict
 
+    ########################################
+    # Device list cache
+    ######################
+    # The config dialogs' device lists are built with one pass over the devices that can be in
+    # them the first time one is needed. From then on deviceCreated, deviceUpdated and
+    # deviceDeleted keep every device's (name, lists it is in, is a dimmer) current, and a list
+    # is only sorted again after one of its devices has changed.
+    def _pickerEntries(self):
+        if self.pickerEntries is None:
+            self.pickerEntries = {}
+            for dev in self._iterDevices(PICKER_FILTER):
+                self._setPickerEntry(dev)
+        return self.pickerEntries
+
+    def _pickerList(self, name):
+        menuItems = self.pickerLists.get(name)
+        if menuItems is None:
+            menuItems = sorted(((devId, entry[0]) for devId, entry in list(self._pickerEntries().items()) if name in entry[1]),
+                               key=lambda item: item[1].lower())
+            self.pickerLists[name] = menuItems
+        return menuItems
+
+    def _setPickerEntry(self, dev, extraList=None):
+        lists = set()
+        if isinstance(dev, (indigo.RelayDevice, indigo.DimmerDevice, indigo.SensorDevice)) or dev.ownerProps.get("SupportsOnState"):
+            lists.add("onState")
+        if dev.ownerProps.get("SupportsEnergyMeter"):
+            lists.add("energyMeters")
+        lists.update(f"attr:{attribute}" for attribute in self.pickerAttributes if hasattr(dev, attribute))
+        if extraList is not None:
+            lists.add(extraList)
+        entry = (dev.name, frozenset(lists), "brightnessLevel" in dev.states)
+        old = self.pickerEntries.get(dev.id)
+        if entry != old:
+            self.pickerEntries[dev.id] = entry
+            self._dropPickerLists(entry, old)
+
+    def _removePickerEntry(self, devId):
+        if self.pickerEntries is not None:
+            self._dropPickerLists(self.pickerEntries.pop(devId, None))
+
+    def _dropPickerLists(self, *entries):
+        for entry in entries:
+            if entry is not None:
+                for name in entry[1]:
+                    self.pickerLists.pop(name, None)
+
+    def deviceCreated(self, dev):
+        if self.pickerEntries is not None:
+            self._setPickerEntry(dev)
+        indigo.PluginBase.deviceCreated(self, dev)  # be sure and call parent function
+
     ########################################
     # Device Com
     ######################
     def deviceStartComm(self, dev):
-        if dev.deviceTypeId == "virtualDeviceEnergyMeter":
-            if int(dev.ownerProps["parentDeviceId"]) not in indigo.devices:
-                self.logger.warn(f"Parent device does not exist any more for device {dev.name}")
-            else:
-                self.parentDevIdsWeUseDict.append(int(dev.ownerProps["parentDeviceId"]))
-        elif dev.deviceTypeId == "virtualGroupEnergyMeter":
-            for devId in dev.ownerProps["childEnergyMeters"]:
-                if int(devId) not in indigo.devices:
-                    self.logger.warn(f"Child device {devId} does not exist any more for device {dev.name}")
-                else:
-                    self.parentDevIdsWeUseDict.append(int(devId))
-        self._refreshState(dev)
+        dev.stateListOrDisplayStateIdChanged()
+        with self.eventLock:
+            if self.startingDevices is not None:
+                self.startingDevices[dev.id] = dev
+                return
+        self._queueEvent(self._startMeter, time.time(), dev)
 
     def deviceStopComm(self, dev):
-        if dev.deviceTypeId == "virtualDeviceEnergyMeter":
-            if int(dev.ownerProps["parentDeviceId"]) not in indigo.devices:
-                self.logger.warn(f"Parent device does not exist any more for device {dev.name}")
+        with self.eventLock:
+            if self.startingDevices is not None and self.startingDevices.pop(dev.id, None) is not None:
+                return
+        self._queueEvent(self._stopMeter, time.time(), dev)
+
+    def _finishStartup(self, startingDevices):
+        # Starts every device collected since startup in one pass: index everything and
+        # compile the power curves, then refresh the device meters and after them the groups
+        # in rank order. Group propagation is off meanwhile, every group adds up its children
+        # when it is refreshed, so nothing is published with a partial total.
+        if startingDevices is None:
+            return
+        devs = list(startingDevices.values())
+        startedTS = time.perf_counter()
+        ts = time.time()
+        meters = []
+        for dev in devs:
+            if dev.deviceTypeId == "pluginStatistics":
+                self.statsDeviceIds.add(dev.id)
+                continue
+            self._indexMeter(dev)
+            self._resumeMeter(dev, ts)
+            self._trackMetrics(dev)
+            if dev.deviceTypeId == "virtualDeviceEnergyMeter" and dev.ownerProps.get("parentDeviceDimmer"):
+                self._powerCurve(dev)
+            meters.append(dev)
+        meters.sort(key=lambda dev: self._meterRank(dev.id))
+        indexedTS = time.perf_counter()
+
+        self.groupWattsHeld = True
+        try:
+            deviceMeters = [dev for dev in meters if dev.deviceTypeId == "virtualDeviceEnergyMeter"]
+            if self.pluginPrefs.get("batchRefresh", False):
+                self._refreshStatesBatch(deviceMeters, ts)
             else:
-                self.parentDevIdsWeUseDict.remove(int(dev.ownerProps["parentDeviceId"]))
-        elif dev.deviceTypeId == "virtualGroupEnergyMeter":
-            for devId in dev.ownerProps["childEnergyMeters"]:
-                if int(devId) not in indigo.devices:
-                    self.logger.warn(f"Child device {devId} does not exist any more for device {dev.name}")
-                else:
-                    self.parentDevIdsWeUseDict.remove(int(devId))
-        self._refreshState(dev)
+                for dev in deviceMeters:
+                    self._refreshState(dev, ts=ts)
+            for dev in meters:
+                if dev.deviceTypeId != "virtualDeviceEnergyMeter":
+                    self._refreshState(dev, ts=ts)
+        finally:
+            self.groupWattsHeld = False
+        refreshedTS = time.perf_counter()
+        self._flushStates()
+        self.eventFloorTS = time.time()
+        doneTS = time.perf_counter()
+        self.logger.info(f"Started {len(devs)} devices in {(doneTS - self.launchTS) * 1000:.0f} ms: "
+                         f"plugin startup {(self.startupTS - self.launchTS) * 1000:.0f} ms, "
+                         f"deviceStartComm calls {(startedTS - self.startupTS) * 1000:.0f} ms, "
+                         f"indexes and curves {(indexedTS - startedTS) * 1000:.0f} ms, "
+                         f"refresh {(refreshedTS - indexedTS) * 1000:.0f} ms, "
+                         f"state updates {(doneTS - refreshedTS) * 1000:.0f} ms")
+
+    def _startMeter(self, ts, dev):
+        if dev.deviceTypeId == "pluginStatistics":
+            self.statsDeviceIds.add(dev.id)
+        self._indexMeter(dev)
+        self._resumeMeter(dev, ts)
+        self._trackMetrics(dev)
+        self._refreshState(dev, ts=ts)
+        self._flushEventStates(ts)
+
+    def _stopMeter(self, ts, dev):
+        # Settled while the meter is still indexed, a group without its children would
+        # publish 0 W and the downtime would be charged at that after a restart
+        self.statsDeviceIds.discard(dev.id)
+        self._refreshState(dev, ts=ts)
+        self._unindexMeter(dev.id)
+        self._flushEventStates(ts)
+        if self.metrics is not None:
+            self.metrics.remove(dev.id)
+
+    def _refreshMeter(self, ts, dev):
+        self._refreshState(dev, True, ts)
+        self._flushEventStates(ts)
+
+    def _resetEnergy(self, ts, dev):
+        # Sent right away with everything pending, so no earlier write can undo the reset
+        keyValueList = [{'key': 'accumEnergyTotal', 'value': 0.0, 'uiValue': "0.000 kWh"}]
+        if "accumCostTotal" in dev.states:
+            keyValueList.append({'key': 'accumCostTotal', 'value': 0.0, 'uiValue': "0.00"})
+        self._queueStates(dev, keyValueList)
+        self._flushStates(force=True)
 
     ########################################
     # Validation
@@ -161,8 +1423,11 @@ class Plugin(indigo.PluginBase):
     def validateDeviceConfigUi(self, valuesDict, typeId, devId):
         errorDict = indigo.Dict()
         if typeId == "virtualDeviceEnergyMeter":
+            hasPowerCurve = bool(valuesDict.get("powerCurve", "").strip())
             for value in valuesDict:
-                if valuesDict['parentDeviceDimmer']:
+                if valuesDict['parentDeviceDimmer'] and hasPowerCurve:
+                    fieldsToValidate = []
+                elif valuesDict['parentDeviceDimmer']:
                     fieldsToValidate = ["powerAt1", "powerAt33", "powerAt66", "powerAt100"]
                 else:
                     fieldsToValidate = ["powerAtOn"]
@@ -174,28 +1439,157 @@ class Plugin(indigo.PluginBase):
                         valuesDict[value] = 0
                 elif value == "parentDeviceId":
                         valuesDict[value] = int(valuesDict[value])
+            if valuesDict['parentDeviceDimmer'] and hasPowerCurve:
+                try:
+                    self._parsePowerCurve(valuesDict["powerCurve"])
+                except ValueError:
+                    errorDict["powerCurve"] = "Enter the curve as level:watts pairs, for example 1:0.8, 33:4, 66:9, 100:15"
+        elif typeId == "virtualGroupEnergyMeter":
+            if self._groupContainsItself(devId, valuesDict.get("childEnergyMeters", [])):
+                errorDict["childEnergyMeters"] = "A group can not contain itself, directly or through another group"
+        elif typeId == "virtualFormulaEnergyMeter":
+            self._validateFormula(valuesDict, devId, errorDict)
+        if typeId in ("virtualDeviceEnergyMeter", "virtualGroupEnergyMeter", "virtualFormulaEnergyMeter"):
+            try:
+                if int(valuesDict.get("refreshInterval") or 1) < 1:
+                    raise ValueError()
+            except ValueError:
+                errorDict["refreshInterval"] = "Enter a whole number of seconds, or leave it empty to use the polling time"
         if errorDict:
             return (False, valuesDict, errorDict)
         else:
             return (True, valuesDict)
 
+    def _validateFormula(self, valuesDict, devId, errorDict):
+        try:
+            self._parseFormulaInputs(valuesDict.get("formulaInputs", ""))
+        except ValueError:
+            errorDict["formulaInputs"] = "Enter the inputs as alias=device id pairs, for example fan=12345, heater=67890"
+            return
+        try:
+            compiledFormula, inputIds, statesById = self._compileFormula(valuesDict)
+        except formula.FormulaError as e:
+            errorDict["formula"] = str(e)
+            return
+        for inputId, keys in statesById.items():
+            if inputId == devId:
+                errorDict["formulaInputs"] = "A formula meter can not use itself"
+            elif not self._deviceExists(inputId):
+                errorDict["formulaInputs"] = f"There is no device with id {inputId}"
+            else:
+                inputDev = self._getDevice(inputId)
+                if inputDev.pluginId == self.pluginId and inputDev.deviceTypeId != "virtualDeviceEnergyMeter":
+                    errorDict["formulaInputs"] = "Only Virtual Device Energy Meters can be used from this plugin"
+                for key in sorted(keys):
+                    if key not in inputDev.states:
+                        errorDict["formula"] = f"{inputDev.name} has no state {key}"
+
     def validatePrefsConfigUi(self, valuesDict):
         errorDict = indigo.Dict()
         try:
             poll_time = int(valuesDict["deviceUpdate"])
         except:
             poll_time = 300
+        try:
+            if float(valuesDict.get("coalesceWindow", 0)) < 0:
+                raise ValueError()
+        except ValueError:
+            errorDict["coalesceWindow"] = "The value of this field must be 0 or more milliseconds"
+        try:
+            if not 1 <= int(valuesDict.get("flushThreads", 1)) <= 32:
+                raise ValueError()
+        except ValueError:
+            errorDict["flushThreads"] = "Enter a whole number from 1 to 32"
+        for field in ("publishMinWatts", "publishMinKwh", "publishMaxAge"):
+            try:
+                if float(valuesDict.get(field, 0)) < 0:
+                    raise ValueError()
+            except ValueError:
+                errorDict[field] = "The value of this field must be 0 or more"
+        try:
+            if not 1 <= int(valuesDict.get("metricsPort", 9180)) <= 65535:
+                raise ValueError()
+        except ValueError:
+            errorDict["metricsPort"] = "Enter a port number from 1 to 65535"
+        if valuesDict.get("tariffEnabled", False):
+            try:
+                tariff.Tariff(valuesDict.get("tariffRules", ""))
+            except ValueError as e:
+                errorDict["tariffRules"] = str(e)
+        for field in ("historyRawDays", "historyHourlyDays"):
+            try:
+                int(valuesDict.get(field, 0))
+            except ValueError:
+                errorDict[field] = "The value of this field must be a whole number of days"
+        if errorDict:
+            return (False, valuesDict, errorDict)
         return (True, valuesDict)
 
+    def validateMenuConfigUi(self, valuesDict, typeId, devId):
+        errorDict = indigo.Dict()
+        if typeId == "logEnergyUsage":
+            if self.history is None:
+                errorDict["meterId"] = "Energy history is not enabled in the plugin configuration"
+            for field in ("start", "end"):
+                try:
+                    self._parseLocalTime(valuesDict.get(field, ""))
+                except ValueError:
+                    errorDict[field] = "Enter a time as YYYY-MM-DD HH:MM or YYYY-MM-DD"
+        elif typeId == "replayEventLog":
+            if not os.path.isfile(valuesDict.get("eventLogPath", "").strip()):
+                errorDict["eventLogPath"] = "There is no such file"
+            if not valuesDict.get("meterIds"):
+                errorDict["meterIds"] = "Select at least one energy meter"
+            for field in ("start", "end"):
+                if valuesDict.get(field, "").strip():
+                    try:
+                        self._parseLocalTime(valuesDict[field])
+                    except ValueError:
+                        errorDict[field] = "Enter a time as YYYY-MM-DD HH:MM or YYYY-MM-DD, or leave it empty"
+            if valuesDict.get("rewriteEnergy", False) and valuesDict.get("end", "").strip():
+                errorDict["end"] = "Leave this empty to rewrite the totals, they must be replayed up to now"
+        elif typeId == "profilePlugin":
+            if self.profiler is not None:
+                errorDict["seconds"] = "The plugin is being profiled already"
+            try:
+                if not 1 <= float(valuesDict.get("seconds", 60)) <= PROFILE_MAX_SECONDS:
+                    raise ValueError()
+            except ValueError:
+                errorDict["seconds"] = f"Enter from 1 to {PROFILE_MAX_SECONDS} seconds"
+            try:
+                if not 1 <= int(valuesDict.get("maxCalls", 100000)) <= PROFILE_MAX_CALLS:
+                    raise ValueError()
+            except ValueError:
+                errorDict["maxCalls"] = f"Enter a whole number from 1 to {PROFILE_MAX_CALLS}"
+        if errorDict:
+            return (False, valuesDict, errorDict)
+        else:
+            return (True, valuesDict)
+
     ########################################
     # Methods for changes in Device states
     ########################################
     def deviceDeleted(self, dev):
-        self.logger.debug(f"Device {dev.name} deleted")
+        self._removePickerEntry(dev.id)
+        self._queueEvent(self._handleDeviceDeleted, time.time(), dev)
+        indigo.PluginBase.deviceDeleted(self, dev)  # be sure and call parent function
 
-        if dev.id in self.parentDevIdsWeUseDict:
-            ts = time.time()
-            deviceEnergyMeters = list(filter(lambda x: x.deviceTypeId == "virtualDeviceEnergyMeter" and x.ownerProps["parentDeviceId"] == str(dev.id), indigo.devices.iter("self")))
+    def _handleDeviceDeleted(self, ts, dev):
+        self.logger.debug(f"Device {dev.name} deleted")
+        if self.journal is not None and dev.pluginId == self.pluginId:
+            self.journal.forget(dev.id)
+        # deviceStopComm has usually settled the meter already, after dev was taken
+        settledTS = max(self.settledTS.pop(dev.id, 0), self._stateValue(dev, "accumEnergyTotalTS", 0) or 0) or ts
+        self.heldStates.pop(dev.id, None)
+        self.publishedStates.pop(dev.id, None)
+
+        self._unindexMeter(dev.id)
+        if self.groupFromChildEnergy and dev.pluginId == self.pluginId and dev.id in self.groupIdsByChildId and ts > settledTS:
+            self._addChildEnergy(dev.id, (ts - settledTS) / 3600 * self.meterWatts.get(dev.id, 0.0) / 1000, ts, settledTS)
+        if dev.id in self.meterIdsByParentId or dev.id in self.groupIdsByChildId:
+            formulaMeterIds = [meterId for meterId in self.meterIdsByParentId.get(dev.id, ()) if meterId in self.formulas]
+            deviceEnergyMeters = [self._getDevice(meterId) for meterId in self.meterIdsByParentId.get(dev.id, ())
+                                  if meterId not in self.formulas]
             for deviceEnergyMeter in deviceEnergyMeters:
                 self.logger.warn(f"Parent device {dev.name} has been deleted, you must update Virtual Energy Device {deviceEnergyMeter.name} or delete it.")
                 if dev.states['onOffState']:
@@ -206,77 +1600,98 @@ class Plugin(indigo.PluginBase):
                     else:
                         self.logger.debug(f"Parent device {dev.name} is not a dimmer")
                         watts = float(deviceEnergyMeter.ownerProps["powerAtOn"])
-                    accumEnergyTotalTS = deviceEnergyMeter.states.get("accumEnergyTotalTS", ts)
+                    accumEnergyTotalTS = self._stateValue(deviceEnergyMeter, "accumEnergyTotalTS", ts)
                     energy = ((ts - accumEnergyTotalTS) / 3600 * watts) / 1000
                 else:
                     energy = 0
 
                 self._addAccumEnergy(deviceEnergyMeter, energy, ts, True, True)
-
-            groupEnergyMeters = list(filter(lambda x: x.deviceTypeId == "virtualGroupEnergyMeter" and str(dev.id) in x.ownerProps["childEnergyMeters"], indigo.devices.iter("self")))
-
-            for groupEnergyMeter in groupEnergyMeters:
-                self.logger.warn(f"Child device {dev.name} has been deleted, it has been removed from Virtual Group Energy Meter {groupEnergyMeter.name}")
-                accumEnergyTotalTS = groupEnergyMeter.states.get("accumEnergyTotalTS", ts)
-                power = 0.0
-                for devId in groupEnergyMeter.ownerProps["childEnergyMeters"]:
-                    if devId == str(dev.id):
-                        watt = dev.states.get('curEnergyLevel', 0)
-                        power = ((ts - accumEnergyTotalTS) / 3600 * watt) / 1000
-                    else:
-                        childWatt = indigo.devices[int(devId)].states.get('curEnergyLevel', 0)
-                        power += ((ts - accumEnergyTotalTS) / 3600 * childWatt) / 1000
-                self._addAccumEnergy(dev, power, ts, True, True)
-
-                groupEnergyMeter.ownerProps["childEnergyMeters"].remove(str(dev.id))
-            self.parentDevIdsWeUseDict = list(filter(lambda a: a != dev.id, self.parentDevIdsWeUseDict))
-
-        indigo.PluginBase.deviceDeleted(self, dev)  # be sure and call parent function
+                self._applyWattsChange(deviceEnergyMeter.id, 0.0, ts)
+
+            for groupId in self.groupIdsByChildId.get(dev.id, ()):
+                self.logger.warn(f"Child device {dev.name} has been deleted, it has been removed from Virtual Group Energy Meter {self._getDevice(groupId).name}")
+            self._applyWattsChange(dev.id, 0.0, ts)
+            self._unindexWatchedDevice(dev.id)
+            for meterId in formulaMeterIds:
+                formulaMeter = self._getDevice(meterId)
+                self.logger.warn(f"Input device {dev.name} has been deleted, you must update Virtual Formula Energy Meter {formulaMeter.name} or delete it.")
+                self.formulaWatts.pop(meterId, None)
+                self._refreshState(formulaMeter, ts=ts)
+        self.meterWatts.pop(dev.id, None)
+        self._flushEventStates(ts)
+        if self.metrics is not None:
+            self.metrics.remove(dev.id)
 
     def deviceUpdated(self, origDev, newDev):
-        ts = time.time()
-        if newDev.deviceTypeId == "virtualDeviceEnergyMeter" or newDev.deviceTypeId == "virtualGroupEnergyMeter":
+        if self.pickerEntries is not None and (origDev.name != newDev.name or origDev.deviceTypeId != newDev.deviceTypeId
+                                               or origDev.ownerProps != newDev.ownerProps):
+            self._setPickerEntry(newDev)
+        if newDev.pluginId == self.pluginId and newDev.id not in self.meterIdsByParentId \
+                and origDev.ownerProps == newDev.ownerProps and origDev.enabled == newDev.enabled \
+                and origDev.configured == newDev.configured:
+            # Our own state updates come back here too, only configuration changes matter
+            # unless a formula meter uses the device
+            self.echoesDropped += 1
+        elif newDev.pluginId == self.pluginId or newDev.id in self.meterIdsByParentId \
+                or newDev.id in self.groupIdsByChildId:
+            self._queueEvent(self._handleDeviceUpdated, time.time(), origDev, newDev)
+        indigo.PluginBase.deviceUpdated(self, origDev, newDev)  # be sure and call parent function
+
+    def _handleDeviceUpdated(self, ts, origDev, newDev):
+        if newDev.id in self.meterIdsByParentId or newDev.id in self.groupIdsByChildId:
+            self._mirrorStates(newDev)
+        if newDev.deviceTypeId in ("virtualDeviceEnergyMeter", "virtualGroupEnergyMeter", "virtualFormulaEnergyMeter"):
             self.logger.debug(f"Device {newDev.name} has change")
+            if origDev.ownerProps != newDev.ownerProps:
+                self._dropPowerCurve(newDev.id)
+                if newDev.id in self.watchedIdsByMeterId:
+                    self._readRefreshInterval(newDev, ts)
             if origDev.configured != newDev.configured:
                 self.logger.debug(f"Device {newDev.name} is configured")
-                self.deviceStartComm(newDev)
+                newDev.stateListOrDisplayStateIdChanged()
+                self._startMeter(ts, newDev)
             elif origDev.enabled != newDev.enabled:
                 if newDev.enabled:
                     self.logger.debug(f"Device {newDev.name} is is enabled")
-                    self.deviceStartComm(origDev)
+                    origDev.stateListOrDisplayStateIdChanged()
+                    self._startMeter(ts, origDev)
                 else:
                     self.logger.debug(f"Device {newDev.name} is is disabled")
-                    self.deviceStopComm(origDev)
+                    self._stopMeter(ts, origDev)
             elif newDev.deviceTypeId == "virtualDeviceEnergyMeter"\
                     and 'parentDeviceId' in origDev.ownerProps\
                     and origDev.ownerProps['parentDeviceId'] != newDev.ownerProps['parentDeviceId']\
-                    and int(origDev.ownerProps["parentDeviceId"]) in indigo.devices:
-                parentDevice = indigo.devices[int(origDev.ownerProps["parentDeviceId"])]
+                    and self._deviceExists(int(origDev.ownerProps["parentDeviceId"])):
+                parentDevice = self._getDevice(int(origDev.ownerProps["parentDeviceId"]))
                 self.logger.debug(f"Device {newDev.name} has changed parent device to {parentDevice.name}")
-                if origDev.ownerProps["parentDeviceId"] in self.parentDevIdsWeUseDict:
-                    self.parentDevIdsWeUseDict.remove(int(origDev.ownerProps["parentDeviceId"]))
-                self.parentDevIdsWeUseDict.append(int(newDev.ownerProps["parentDeviceId"]))
+                self._indexMeter(newDev)
                 if parentDevice.states['onOffState']:
                     self.logger.debug(f"Parent device {parentDevice.name} is turned on")
                     if "brightnessLevel" in parentDevice.states:
                         self.logger.debug(f"Parent device {parentDevice.name} is a dimmer")
-                        watts = self.getCurPower(origDev, int(parentDevice.states.get("brightnessLevel")))
+                        watts = self._compilePowerCurve(origDev.ownerProps)[int(parentDevice.states.get("brightnessLevel"))]
                     else:
                         self.logger.debug(f"Parent device {parentDevice.name} is not a dimmer")
                         watts = float(origDev.ownerProps["powerAtOn"])
-                    accumEnergyTotalTS = origDev.states.get("accumEnergyTotalTS", ts)
+                    accumEnergyTotalTS = self._stateValue(origDev, "accumEnergyTotalTS", ts)
                     energy = ((ts - accumEnergyTotalTS) / 3600 * watts) / 1000
                 else:
                     energy = 0
 
                 self._addAccumEnergy(newDev, energy, ts)
-                self._refreshState(newDev)
+                self._refreshState(newDev, ts=ts)
 
             elif newDev.deviceTypeId == "virtualGroupEnergyMeter" \
                     and origDev.ownerProps['childEnergyMeters'] != newDev.ownerProps['childEnergyMeters']:
-                self._refreshState(newDev)
+                self._indexMeter(newDev)
+                self._refreshState(newDev, ts=ts)
+
+            elif newDev.deviceTypeId == "virtualFormulaEnergyMeter" and origDev.ownerProps != newDev.ownerProps:
+                self._indexMeter(newDev)
+                self._refreshState(newDev, ts=ts)
 
-        if newDev.id not in self.parentDevIdsWeUseDict:
+        if newDev.id not in self.meterIdsByParentId and newDev.id not in self.groupIdsByChildId:
+            self._flushEventStates(ts)
             return
         else:
                 self.logger.debug(f"Device {newDev.name} has change")
@@ -286,7 +1701,8 @@ class Plugin(indigo.PluginBase):
             self.logger.debug(f"The parent device, {origDev.name}, has changed onOff state or brightness level")
             #TODO: Fix error handling if dev don't exists
             self.logger.debug(f"Getting all Virtual Energy Meters with parent device: {origDev.name}")
-            devs = list(filter(lambda x: x.deviceTypeId == "virtualDeviceEnergyMeter" and x.ownerProps["parentDeviceId"] == str(origDev.id), indigo.devices.iter("self")))
+            devs = [self._getDevice(meterId) for meterId in self.meterIdsByParentId.get(origDev.id, ())
+                    if meterId not in self.formulas]
             self.logger.debug(f"Found {len(devs)} Virtual Energy Meters with parent device: {origDev.name}")
             for dev in devs:
                 self.logger.debug(f"Syncing Virtual Energy Meter {dev.name} with {origDev.name}")
@@ -295,41 +1711,76 @@ class Plugin(indigo.PluginBase):
                         watts = self.getCurPower(dev, int(origDev.states.get("brightnessLevel")))
                     else:
                         watts = float(dev.ownerProps["powerAtOn"])
-                    accumEnergyTotalTS = dev.states.get("accumEnergyTotalTS", ts)
+                    accumEnergyTotalTS = self._stateValue(dev, "accumEnergyTotalTS", ts)
                     energy = ((ts - accumEnergyTotalTS) / 3600 * watts) / 1000
                 else:
                     energy = 0
                 self._addAccumEnergy(dev, energy, ts)
-                self._refreshState(dev)
+                self._refreshState(dev, ts=ts)
+        for meterId in list(self.meterIdsByParentId.get(newDev.id, ())):
+            if meterId in self.formulas and self._formulaInputChanged(meterId, origDev, newDev):
+                self.formulaWatts.pop(meterId, None)
+                self._refreshState(self._getDevice(meterId), ts=ts)
+        if self.groupFromChildEnergy and newDev.pluginId != self.pluginId and newDev.id in self.groupIdsByChildId \
+                and "accumEnergyTotal" in newDev.states \
+                and origDev.states.get("accumEnergyTotal") != newDev.states["accumEnergyTotal"]:
+            self._childEnergyChanged(origDev, newDev, ts)
         if ("curEnergyLevel" in origDev.states and origDev.states['curEnergyLevel'] != newDev.states['curEnergyLevel']):
             # or ("accumEnergyTotal" in origDev.states and origDev.states['accumEnergyTotal'] != newDev.states['accumEnergyTotal']) \
             self.logger.debug(f"Device, {origDev.name} has changed curEnergyLevel")
-            devs = list(filter(lambda x: x.deviceTypeId == "virtualGroupEnergyMeter" and str(origDev.id) in x.ownerProps["childEnergyMeters"], indigo.devices.iter("self")))
-            self.logger.debug(f"Found {len(devs)} Virtual Group Energy Meters with child device: {origDev.name}")
-            for dev in devs:
-                self.logger.debug(f"Device {origDev.name} has change, update Group Energy Meter {dev.name}")
-                ts = time.time()
-                accumEnergyTotalTS = dev.states.get("accumEnergyTotalTS", ts)
-                power = 0.0
-                for devId in dev.ownerProps["childEnergyMeters"]:
-                    if devId == str(origDev.id):
-                        watt = origDev.states.get('curEnergyLevel', 0)
-                        power = ((ts - accumEnergyTotalTS) / 3600 * watt) / 1000
-                    else:
-                        childWatt = indigo.devices[int(devId)].states.get('curEnergyLevel', 0)
-                        power += ((ts - accumEnergyTotalTS) / 3600 * childWatt) / 1000
-                self._addAccumEnergy(dev, power, ts)
-                self._refreshState(dev)
-
-        indigo.PluginBase.deviceUpdated(self, origDev, newDev)  # be sure and call parent function
+            # Our own meters already pushed their change through the groups in _refreshState
+            if newDev.pluginId != self.pluginId:
+                self._applyWattsChange(newDev.id, newDev.states['curEnergyLevel'], ts)
+        self._flushEventStates(ts)
 
     def getCurPower(self, dev, dimLevel):
-        xp = [1, 33, 66, 100]
-        fp = [float(dev.ownerProps["powerAt1"]),
-              float(dev.ownerProps["powerAt33"]),
-              float(dev.ownerProps["powerAt66"]),
-              float(dev.ownerProps["powerAt100"])]
-        return np.interp(dimLevel, xp, fp)
+        return self._powerCurve(dev)[min(max(dimLevel, 0), 100)]
+
+    ########################################
+    # Power curves
+    ######################
+    def _powerCurve(self, dev):
+        curve = self.powerCurves.get(dev.id)
+        if curve is None:
+            curve = self.powerCurves[dev.id] = self._compilePowerCurve(dev.ownerProps)
+        return curve
+
+    def _dropPowerCurve(self, devId):
+        self.powerCurves.pop(devId, None)
+        self.curveStack = None
+
+    def _parsePowerCurve(self, text):
+        points = {}
+        for point in text.replace(";", ",").split(","):
+            if point.strip():
+                level, watts = point.split(":")
+                level = int(level)
+                if not 0 <= level <= 100:
+                    raise ValueError(f"Dim level {level} is outside 0-100")
+                points[level] = float(watts)
+        if not points:
+            raise ValueError("The power curve has no points")
+        return sorted(points.items())
+
+    def _compilePowerCurve(self, props):
+        # Lookup table with the power at every dim level from 0 to 100, interpolated
+        # linearly between the calibration points and flat outside them
+        if props.get("powerCurve", "").strip():
+            points = self._parsePowerCurve(props["powerCurve"])
+        else:
+            points = [(level, float(props[f"powerAt{level}"])) for level in (1, 33, 66, 100)]
+        levels = [level for level, watts in points]
+        curve = []
+        for dimLevel in range(101):
+            if dimLevel <= levels[0]:
+                curve.append(points[0][1])
+            elif dimLevel >= levels[-1]:
+                curve.append(points[-1][1])
+            else:
+                i = bisect.bisect_right(levels, dimLevel)
+                (x0, y0), (x1, y1) = points[i - 1], points[i]
+                curve.append(y0 + (y1 - y0) * (dimLevel - x0) / (x1 - x0))
+        return curve
 
     ########################################
     # General Action callback
@@ -345,7 +1796,7 @@ class Plugin(indigo.PluginBase):
         elif action.deviceAction == indigo.kDeviceGeneralAction.EnergyUpdate:
             # Request hardware module (dev) for its most recent meter data here:
             # ** IMPLEMENT ME **
-            self._refreshState(dev, True)
+            self._queueEvent(self._refreshMeter, time.time(), dev)
 
         ###### ENERGY RESET ######
         elif action.deviceAction == indigo.kDeviceGeneralAction.EnergyReset:
@@ -354,13 +1805,13 @@ class Plugin(indigo.PluginBase):
             indigo.server.log(f"sent \"{dev.name}\" {'energy usage reset'}")
             # And then tell Indigo to reset it by just setting the value to 0.
             # This will automatically reset Indigo's time stamp for the accumulation.
-            dev.updateStateOnServer("accumEnergyTotal", 0.0)
+            self._queueEvent(self._resetEnergy, time.time(), dev)
 
         ###### STATUS REQUEST ######
         elif action.deviceAction == indigo.kDeviceGeneralAction.RequestStatus:
             # Query hardware module (dev) for its current status here:
             # ** IMPLEMENT ME **
-            self._refreshState(dev, True)
+            self._queueEvent(self._refreshMeter, time.time(), dev)
 
     ########################################
     # Custom Plugin Action callbacks (defined in Actions.xml)
@@ -608,6 +2059,19 @@ class Plugin(indigo.PluginBase):
     def closedPrefsConfigUi(self, valuesDict, userCancelled):
         if (not userCancelled):
             self.setLogLevel()
+            self._queueEvent(self._applyPrefs, time.time())
+
+    def _applyPrefs(self, ts):
+        # Runs on the concurrent thread, which checks these and then uses them, so
+        # they must not change under it
+        self._setupHistory()
+        self._readCoalesceWindow()
+        self._readPublishThresholds()
+        self._readGroupAccumulation()
+        self._setupTariff()
+        self._setupFlushPool()
+        self._setupMetrics()
+        self._setupInstrumentation()
 
     def loggingLevelList(self, filter="", valuesDict=None, typeId="", targetId=0):
         logLevels = [
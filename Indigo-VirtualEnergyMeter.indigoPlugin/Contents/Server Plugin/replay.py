@@ -0,0 +1,133 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+# Replays recorded device events through meters' power curves to work out what they used,
+# for meters added or recalibrated after the fact. An event log has one row per event:
+#   timestamp, device id, onOffState, brightnessLevel
+# as CSV (brightnessLevel empty for on/off devices) or as a .npy array of the same four
+# columns. A device keeps the state of its last event until its next one, before its
+# first event it counts as off.
+COLUMNS = 4
+ON_STATES = {"1": 1.0, "0": 0.0, "1.0": 1.0, "0.0": 0.0, "true": 1.0, "false": 0.0, "on": 1.0, "off": 0.0}
+
+
+def parseOnOff(text):
+    return ON_STATES[text.strip().lower()]
+
+
+def parseLevel(text):
+    return float(text) if text.strip() else np.nan
+
+
+def loadEvents(path):
+    if path.endswith(".npy"):
+        events = np.load(path)
+    else:
+        with open(path) as f:
+            firstLine = f.readline()
+        try:
+            float(firstLine.split(",")[0])
+            header = 0
+        except ValueError:
+            header = 1
+        events = np.loadtxt(path, delimiter=",", dtype=float, skiprows=header, ndmin=2,
+                            converters={2: parseOnOff, 3: parseLevel})
+    if events.ndim != 2 or events.shape[1] != COLUMNS:
+        raise ValueError(f"{path} does not have the columns timestamp, device id, onOffState, brightnessLevel")
+    return events
+
+
+class EventLog:
+    # Events sorted by device and then time, so every device's events are one slice
+    def __init__(self, events):
+        order = np.lexsort((events[:, 0], events[:, 1]))
+        events = events[order]
+        self.ts = np.ascontiguousarray(events[:, 0])
+        self.on = np.ascontiguousarray(events[:, 2]) != 0
+        self.levels = np.ascontiguousarray(events[:, 3])
+        self.deviceIds, self.starts = np.unique(events[:, 1].astype(np.int64), return_index=True)
+        self.ends = np.append(self.starts[1:], len(events))
+
+    def __len__(self):
+        return len(self.ts)
+
+    def firstTS(self):
+        return float(self.ts.min()) if len(self.ts) else 0.0
+
+    def device(self, devId):
+        i = np.searchsorted(self.deviceIds, devId)
+        if i == len(self.deviceIds) or self.deviceIds[i] != devId:
+            return slice(0, 0)
+        return slice(self.starts[i], self.ends[i])
+
+    def watts(self, devId, power):
+        # power is the watts when on for on/off devices, or the 101 point curve of a dimmer.
+        # Dimmer events without a level keep the last known one, full brightness if there is none.
+        events = self.device(devId)
+        on = self.on[events]
+        if np.ndim(power) == 0:
+            return self.ts[events], np.where(on, float(power), 0.0)
+        levels = self.levels[events]
+        missing = np.isnan(levels)
+        if missing.any():
+            known = np.where(missing, 0, np.arange(len(levels)))
+            np.maximum.accumulate(known, out=known)
+            levels = levels[known]
+            levels[np.isnan(levels)] = 100
+        levels = np.clip(levels, 0, 100).astype(np.intp)
+        return self.ts[events], np.where(on, np.asarray(power, dtype=float)[levels], 0.0)
+
+
+def replay(log, meters, start, end):
+    # meters maps a meter id to (parent device id, power), returns the kWh of every meter from start to end
+    energy = {}
+    for meterId, (parentId, power) in meters.items():
+        ts, watts = log.watts(parentId, power)
+        first = max(np.searchsorted(ts, start, side="right") - 1, 0)
+        segmentStarts = np.clip(ts[first:], start, end)
+        segmentEnds = np.append(segmentStarts[1:], end)
+        energy[meterId] = float(np.dot(watts[first:], segmentEnds - segmentStarts)) / 3600000
+    return energy
+
+
+def curveFromPoints(points):
+    # Linear between the level:watts points and flat outside them, like the plugin's power curves
+    levels, watts = zip(*sorted(points))
+    return np.interp(np.arange(101), levels, watts)
+
+
+def parseMeter(text):
+    # parentId=watts for an on/off device, parentId=level:watts,... for a dimmer
+    parentId, _, power = text.partition("=")
+    if ":" not in power:
+        return int(parentId), float(power)
+    points = [point.split(":") for point in power.split(",") if point.strip()]
+    return int(parentId), curveFromPoints([(int(level), float(watts)) for level, watts in points])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Work out what meters used from a recorded device event log")
+    parser.add_argument("eventLog", help="CSV or .npy file with timestamp, device id, onOffState, brightnessLevel")
+    parser.add_argument("--meter", type=parseMeter, action="append", required=True, metavar="PARENT=POWER",
+                        help="e.g. 12345=100 for a relay or 23456=1:0.8,33:4,66:9,100:15 for a dimmer, can be repeated")
+    parser.add_argument("--start", type=float, help="Unix timestamp, default the first event")
+    parser.add_argument("--end", type=float, help="Unix timestamp, default now")
+    args = parser.parse_args()
+    startedTS = time.perf_counter()
+    log = EventLog(loadEvents(args.eventLog))
+    loadedTS = time.perf_counter()
+    start = args.start if args.start is not None else log.firstTS()
+    end = args.end if args.end is not None else time.time()
+    energy = replay(log, {i: meter for i, meter in enumerate(args.meter)}, start, end)
+    doneTS = time.perf_counter()
+    for i, (parentId, power) in enumerate(args.meter):
+        print(f"{parentId:>10} {energy[i]:12.3f} kWh")
+    print(f"{len(log)} events from {os.path.basename(args.eventLog)}: loaded in {(loadedTS - startedTS) * 1000:.0f} ms, "
+          f"replayed in {(doneTS - loadedTS) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import cProfile
+import io
+import marshal
+import math
+import pstats
+import threading
+import time
+
+# Latencies are counted in log spaced buckets, 8 per doubling from 1 µs up to about 70 minutes,
+# so adding a sample is a log and a list increment and percentiles are within 9% of the real value.
+BUCKETS_PER_DOUBLING = 8
+BUCKETS = 32 * BUCKETS_PER_DOUBLING
+
+
+def bucketLimit(bucket):
+    return 2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING) / 1000000
+
+
+class LatencyHistogram:
+    # Rolling histogram, percentiles cover the current window and the one before it
+    def __init__(self, window=300.0):
+        self.window = window
+        self.windowStart = time.perf_counter()
+        self.current = [0] * BUCKETS
+        self.previous = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+
+    def add(self, seconds, now):
+        if now - self.windowStart >= self.window:
+            self.previous, self.current = self.current, [0] * BUCKETS
+            self.windowStart = now
+        if seconds > 0.000001:
+            self.current[min(int(math.log2(seconds * 1000000) * BUCKETS_PER_DOUBLING), BUCKETS - 1)] += 1
+        else:
+            self.current[0] += 1
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+
+    def percentiles(self, *quantiles):
+        counts = [a + b for a, b in zip(self.current, self.previous)]
+        samples = sum(counts)
+        if not samples:
+            return [0.0] * len(quantiles)
+        results = []
+        for quantile in quantiles:
+            seen, target = 0, quantile * samples
+            for bucket, count in enumerate(counts):
+                seen += count
+                if seen >= target:
+                    break
+            results.append(bucketLimit(bucket))
+        return results
+
+
+class Instrumentation:
+    # Times methods by replacing them with timing wrappers on the instance, so nothing is
+    # left in the call path once they are unwrapped again
+    def __init__(self, window=300.0):
+        self.window = window
+        self.histograms = {}
+        self.wrapped = []
+        self.startTS = time.time()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram(self.window)
+        return histogram
+
+    def wrap(self, obj, names):
+        for attribute, name in names.items():
+            setattr(obj, attribute, self._timed(self.histogram(name), getattr(obj, attribute)))
+            self.wrapped.append(attribute)
+
+    def unwrap(self, obj):
+        for attribute in self.wrapped:
+            delattr(obj, attribute)
+        self.wrapped = []
+
+    def _timed(self, histogram, method):
+        perfCounter = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = perfCounter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                end = perfCounter()
+                histogram.add(end - start, end)
+        return timed
+
+    def summary(self):
+        # (name, calls, p50, p95, p99, last) with the times in milliseconds
+        rows = []
+        for name, histogram in self.histograms.items():
+            p50, p95, p99 = histogram.percentiles(0.50, 0.95, 0.99)
+            rows.append((name, histogram.count, p50 * 1000, p95 * 1000, p99 * 1000, histogram.last * 1000))
+        return rows
+
+
+class Profiler:
+    # Profiles methods for a while, with a cProfile.Profile per thread, in the same way
+    # Instrumentation times them. A wrapper that is still in place after the profiler has
+    # stopped (another wrapper went on top of it) only passes the call on.
+    def __init__(self, seconds, maxCalls, onDone):
+        self.endTS = time.time() + seconds
+        self.maxCalls = maxCalls
+        self.onDone = onDone
+        self.calls = 0
+        self.active = True
+        self.inFlight = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = []
+        self.wrapped = {}
+        self.startTS = time.time()
+
+    def wrap(self, obj, attributes):
+        for attribute in attributes:
+            wrapper = self._profiled(getattr(obj, attribute))
+            self.wrapped[attribute] = (wrapper, obj.__dict__.get(attribute))
+            setattr(obj, attribute, wrapper)
+
+    def unwrap(self, obj):
+        # Puts back what was there before, Instrumentation's wrappers included
+        for attribute, (wrapper, previous) in self.wrapped.items():
+            if obj.__dict__.get(attribute) is not wrapper:
+                continue
+            if previous is None:
+                delattr(obj, attribute)
+            else:
+                setattr(obj, attribute, previous)
+        self.wrapped = {}
+
+    def done(self):
+        return not self.active or time.time() >= self.endTS
+
+    def _profiled(self, method):
+        def profiled(*args, **kwargs):
+            local = self.local
+            if not self.active or getattr(local, "depth", 0):
+                return method(*args, **kwargs)
+            with self.lock:
+                profile = None
+                finished = self.active and (self.calls >= self.maxCalls or time.time() >= self.endTS)
+                if finished:
+                    self.active = False
+                elif self.active:
+                    self.calls += 1
+                    self.inFlight += 1
+                    profile = getattr(local, "profile", None)
+                    if profile is None:
+                        profile = local.profile = cProfile.Profile()
+                        self.profiles.append(profile)
+            if profile is None:
+                if finished:
+                    self.onDone()
+                return method(*args, **kwargs)
+            local.depth = 1
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ allows one profiler at a time, it sees every thread
+                profile = None
+            try:
+                return method(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                local.depth = 0
+                with self.lock:
+                    self.inFlight -= 1
+        return profiled
+
+    def stop(self, obj, timeout=2.0):
+        # Returns the combined pstats.Stats, or None when nothing was profiled
+        self.active = False
+        self.unwrap(obj)
+        waitUntil = time.perf_counter() + timeout
+        while self.inFlight and time.perf_counter() < waitUntil:
+            time.sleep(0.01)
+        combined = None
+        for profile in self.profiles:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if combined is None:
+                combined = pstats.Stats(profile)
+            else:
+                combined.add(profile)
+        return combined
+
+
+def hotspots(profileStats, sortBy="tottime", limit=20):
+    # The usual pstats table, one line per row
+    output = io.StringIO()
+    profileStats.stream = output
+    profileStats.sort_stats(sortBy).print_stats(limit)
+    return [line for line in output.getvalue().splitlines() if line.strip()]
+
+
+def dumpStats(profileStats, path, maxBytes):
+    # Saves the stats like pstats.Stats.dump_stats, leaving out the functions that took
+    # the least time themselves until the file fits. Returns how many were left out.
+    functions = sorted(profileStats.stats.items(), key=lambda item: item[1][2], reverse=True)
+    keep = len(functions)
+    data = marshal.dumps(profileStats.stats)
+    while len(data) > maxBytes and keep > 1:
+        keep = max(min(keep - 1, int(keep * maxBytes / len(data))), 1)
+        data = marshal.dumps(dict(functions[:keep]))
+    with open(path, "wb") as f:
+        f.write(data)
+    return len(functions) - keep
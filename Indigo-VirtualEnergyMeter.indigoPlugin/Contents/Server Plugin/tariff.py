@@ -0,0 +1,146 @@
+import bisect
+import re
+import time
+
+# Time-of-use tariffs, one rule per line (or separated by ;), later rules win where they overlap:
+#   default 0.20
+#   weekdays 07:00-21:00 0.35
+#   sat,sun 09:00-13:00 0.25
+#   jun-aug mon-fri 12:00-18:00 0.45
+# Each rule has optional months, optional days, an optional local time window (which may
+# wrap past midnight) and a rate per kWh. Without a default line the rate outside all
+# windows is 0.
+#
+# The rules are compiled into the local times the rate changes at, with the running
+# integral of the rate over time at each of them, for INDEX_DAYS ahead. The cost of energy
+# used at a constant power between two times is then two bisects and a few multiplies.
+INDEX_DAYS = 7
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+DAY_GROUPS = {"default": set(range(7)), "all": set(range(7)), "daily": set(range(7)),
+              "weekdays": set(range(5)), "weekends": {5, 6}}
+WINDOW = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$")
+
+
+class TariffRule:
+    def __init__(self, months, days, startMinute, endMinute, rate):
+        self.months = months
+        self.days = days
+        self.startMinute = startMinute
+        self.endMinute = endMinute
+        self.rate = rate
+
+    def matches(self, localTime):
+        if localTime.tm_mon not in self.months:
+            return False
+        minute = localTime.tm_hour * 60 + localTime.tm_min
+        if self.startMinute <= self.endMinute:
+            return localTime.tm_wday in self.days and self.startMinute <= minute < self.endMinute
+        # Windows past midnight belong to the day they start on
+        if minute >= self.startMinute:
+            return localTime.tm_wday in self.days
+        return minute < self.endMinute and (localTime.tm_wday - 1) % 7 in self.days
+
+
+def parseNames(text, names):
+    # mon-fri, sat,sun or jun-aug style lists, returns the positions in names
+    selected = set()
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        start = names.index(first)
+        end = names.index(last) if last else start
+        selected.update(i % len(names) for i in range(start, end + 1 if end >= start else end + len(names) + 1))
+    return selected
+
+
+def parseRules(text):
+    rules = []
+    for line in text.replace(";", "\n").splitlines():
+        words = line.lower().split()
+        if not words:
+            continue
+        try:
+            rate = float(words[-1])
+        except ValueError:
+            raise ValueError(f"{line.strip()}: the last word must be the rate per kWh")
+        months, days, startMinute, endMinute = set(range(1, 13)), set(range(7)), 0, 24 * 60
+        for word in words[:-1]:
+            window = WINDOW.match(word)
+            try:
+                if window:
+                    startHour, startMin, endHour, endMin = (int(x) for x in window.groups())
+                    startMinute, endMinute = startHour * 60 + startMin, endHour * 60 + endMin
+                    if startMinute > 24 * 60 or endMinute > 24 * 60 or startMin > 59 or endMin > 59:
+                        raise ValueError()
+                elif word in DAY_GROUPS:
+                    days = DAY_GROUPS[word]
+                elif word[:3] in MONTHS:
+                    months = {month + 1 for month in parseNames(word, MONTHS)}
+                else:
+                    days = parseNames(word, DAYS)
+            except ValueError:
+                raise ValueError(f"{line.strip()}: can not understand {word}")
+        rules.append(TariffRule(months, days, startMinute, endMinute, rate))
+    return rules
+
+
+class Tariff:
+    def __init__(self, text):
+        self.rules = parseRules(text)
+        if not self.rules:
+            raise ValueError("The tariff has no rules")
+        self.minutes = sorted({0} | {rule.startMinute % (24 * 60) for rule in self.rules}
+                              | {rule.endMinute % (24 * 60) for rule in self.rules})
+        self.boundaries = []
+        self.rates = []
+        self.integrals = []
+        self.boundaryEnd = 0
+
+    def rateAt(self, localTime):
+        for rule in reversed(self.rules):
+            if rule.matches(localTime):
+                return rule.rate
+        return 0.0
+
+    def _build(self, start, end):
+        # The rate can only change at one of the rules' minutes, starting at local midnight
+        day = time.localtime(start)
+        boundaries = []
+        for dayOffset in range(int((end - start) // 86400) + 2):
+            for minute in self.minutes:
+                boundaries.append(time.mktime((day.tm_year, day.tm_mon, day.tm_mday + dayOffset,
+                                               minute // 60, minute % 60, 0, 0, 0, -1)))
+        self.boundaries, self.rates, self.integrals = [], [], []
+        integral = 0.0
+        for ts in sorted(set(boundaries)):
+            rate = self.rateAt(time.localtime(ts))
+            if self.rates and rate == self.rates[-1]:
+                continue
+            if self.boundaries:
+                integral += self.rates[-1] * (ts - self.boundaries[-1]) / 3600
+            self.boundaries.append(ts)
+            self.rates.append(rate)
+            self.integrals.append(integral)
+        self.boundaryEnd = end
+
+    def _covers(self, start, end):
+        if not self.boundaries or start < self.boundaries[0] or end >= self.boundaryEnd:
+            self._build(start, end + INDEX_DAYS * 86400)
+
+    def _integral(self, ts):
+        # Cost of one kW from the start of the index up to ts
+        i = bisect.bisect_right(self.boundaries, ts) - 1
+        return self.integrals[i] + self.rates[i] * (ts - self.boundaries[i]) / 3600
+
+    def rate(self, ts):
+        self._covers(ts, ts)
+        return self.rates[bisect.bisect_right(self.boundaries, ts) - 1]
+
+    def cost(self, energy, start, end):
+        # Cost of energy kWh used at a constant power from start to end
+        if not energy:
+            return 0.0
+        if end <= start:
+            return energy * self.rate(end)
+        self._covers(start, end)
+        return energy * (self._integral(end) - self._integral(start)) / ((end - start) / 3600)
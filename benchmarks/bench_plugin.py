@@ -0,0 +1,274 @@
+"""Benchmarks for the Virtual Energy Meter plugin, run against benchmarks/fake_indigo.py.
+
+    python benchmarks/bench_plugin.py --meters 10000 --latency-ms 0.05
+    python benchmarks/bench_plugin.py --scenario ramp --pref coalesceWindow=500
+
+Each scenario reports callback latency percentiles, tick durations and how many
+calls the plugin made into the (fake) Indigo server.
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.join(HERE, "..", "Indigo-VirtualEnergyMeter.indigoPlugin", "Contents", "Server Plugin")
+PLUGIN_ID = "se.cobmedia.indigoplugin.virtualenergymeter"
+
+sys.path.insert(0, HERE)
+import fake_indigo  # noqa: E402
+
+sys.modules["indigo"] = fake_indigo
+sys.path.insert(0, PLUGIN_DIR)
+_spec = importlib.util.spec_from_file_location("plugin", os.path.join(PLUGIN_DIR, "plugin.py"))
+pluginModule = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(pluginModule)
+
+METER_STATES = {"curEnergyLevel": 0.0, "accumEnergyTotal": 0.0, "accumEnergyTotalTS": 0,
+                "energyThisHour": 0.0, "energyLastHour": 0.0, "energyToday": 0.0, "energyThisMonth": 0.0,
+                "accumCostTotal": 0.0, "tariffRate": 0.0}
+PARENT_BASE = 1000000
+METER_BASE = 2000000
+GROUP_BASE = 3000000
+
+
+########################################
+# Fixture
+######################
+def buildHouse(meters, groupSize, dimmerShare=0.5, seed=1):
+    # One parent per meter, every groupSize meters share a group and all groups roll up into a house meter
+    random.seed(seed)
+    devices = fake_indigo.devices
+    for i in range(meters):
+        parentId, meterId = PARENT_BASE + i, METER_BASE + i
+        if random.random() < dimmerShare:
+            devices.add(fake_indigo.Device(parentId, f"Dimmer {i}", deviceClass="dimmer",
+                                           states={"onOffState": True, "brightnessLevel": random.randint(0, 100)}))
+            props = {"parentDeviceId": str(parentId), "parentDeviceDimmer": True, "powerAt1": "1",
+                     "powerAt33": "10", "powerAt66": "25", "powerAt100": "60"}
+        else:
+            devices.add(fake_indigo.Device(parentId, f"Relay {i}", deviceClass="relay",
+                                           states={"onOffState": random.random() < 0.5}))
+            props = {"parentDeviceId": str(parentId), "parentDeviceDimmer": False, "powerAtOn": "100"}
+        props["SupportsEnergyMeter"] = True
+        devices.add(fake_indigo.Device(meterId, f"Meter {i}", "virtualDeviceEnergyMeter", PLUGIN_ID,
+                                       METER_STATES, props))
+    groupIds = []
+    if groupSize:
+        for g, start in enumerate(range(0, meters, groupSize)):
+            children = [str(METER_BASE + i) for i in range(start, min(start + groupSize, meters))]
+            groupIds.append(GROUP_BASE + 1 + g)
+            devices.add(fake_indigo.Device(groupIds[-1], f"Group {g}", "virtualGroupEnergyMeter", PLUGIN_ID,
+                                           METER_STATES, {"childEnergyMeters": children, "SupportsEnergyMeter": True}))
+        devices.add(fake_indigo.Device(GROUP_BASE, "House", "virtualGroupEnergyMeter", PLUGIN_ID, METER_STATES,
+                                       {"childEnergyMeters": [str(groupId) for groupId in groupIds],
+                                        "SupportsEnergyMeter": True}))
+    return groupIds
+
+
+def startPlugin(prefs):
+    plugin = pluginModule.Plugin(PLUGIN_ID, "Virtual Energy Meter", "bench", dict(prefs))
+    plugin.startup()
+    for dev in fake_indigo.devices.iter("self"):
+        plugin.deviceStartComm(dev)
+    # What runConcurrentThread does first; from here on callbacks only queue their events
+    with plugin.eventLock:
+        startingDevices, plugin.startingDevices = plugin.startingDevices, None
+        plugin.workerRunning = True
+    plugin._finishStartup(startingDevices)
+    fake_indigo.devices.deliver()
+    plugin._processEvents()
+    return plugin
+
+
+def stopPlugin(plugin):
+    # What Indigo does at shutdown: the concurrent thread ends, then every device is stopped
+    with plugin.eventLock:
+        plugin.workerRunning = False
+    plugin._processEvents()
+    for dev in fake_indigo.devices.iter("self"):
+        plugin.deviceStopComm(dev)
+    plugin.shutdown()
+
+
+def pump(plugin, timings=None):
+    # Deliver notifications and let the worker handle the events they queued until both are quiet
+    while fake_indigo.devices._notifications or plugin.eventQueue:
+        fake_indigo.devices.deliver()
+        start = time.perf_counter()
+        plugin._processEvents()
+        if timings is not None:
+            timings.append(time.perf_counter() - start)
+
+
+########################################
+# Scenarios
+######################
+def scenarioStartup(args, prefs):
+    buildHouse(args.meters, args.group_size)
+    start = time.perf_counter()
+    startPlugin(prefs)
+    return {"startup": [time.perf_counter() - start]}
+
+
+def scenarioTick(args, prefs):
+    buildHouse(args.meters, args.group_size)
+    plugin = startPlugin(prefs)
+    fake_indigo.counters.clear()
+    ticks = []
+    for i in range(args.repeat):
+        plugin.nextPollTS = 0
+        start = time.perf_counter()
+        plugin._runLoopOnce()
+        pump(plugin)
+        ticks.append(time.perf_counter() - start)
+    return {"tick": ticks}
+
+
+def scenarioRamp(args, prefs):
+    # Ramp every dimmer in a group up and down, like a scene with fades
+    buildHouse(args.meters, args.group_size, dimmerShare=1.0)
+    plugin = startPlugin(prefs)
+    fake_indigo.counters.clear()
+    fake_indigo.callbackTimes.clear()
+    ramped = range(min(args.group_size or args.meters, args.meters))
+    ticks, batches = [], []
+    for step in range(args.repeat):
+        level = abs(100 - (step * 10) % 200)
+        for i in ramped:
+            fake_indigo.devices.setStates(PARENT_BASE + i, brightnessLevel=level)
+        pump(plugin, batches)
+        start = time.perf_counter()
+        plugin._runLoopOnce()
+        pump(plugin)
+        ticks.append(time.perf_counter() - start)
+    if plugin.coalesceFlushTS:
+        plugin.coalesceFlushTS = time.time()
+        plugin._runLoopOnce()
+        pump(plugin)
+    return {"tick": ticks, "worker batch": batches}
+
+
+def scenarioGroup(args, prefs):
+    # One large group whose children all toggle
+    buildHouse(args.group_size, args.group_size, dimmerShare=0.0)
+    plugin = startPlugin(prefs)
+    fake_indigo.counters.clear()
+    fake_indigo.callbackTimes.clear()
+    batches = []
+    for step in range(args.repeat):
+        for i in range(args.group_size):
+            fake_indigo.devices.setStates(PARENT_BASE + i, onOffState=bool(step % 2))
+        pump(plugin, batches)
+    plugin._runLoopOnce()
+    pump(plugin)
+    return {"worker batch": batches}
+
+
+def scenarioDelete(args, prefs):
+    buildHouse(args.meters, args.group_size)
+    plugin = startPlugin(prefs)
+    fake_indigo.counters.clear()
+    fake_indigo.callbackTimes.clear()
+    batches = []
+    for i in range(0, args.meters, 2):
+        fake_indigo.devices.delete(PARENT_BASE + i)
+        pump(plugin, batches)
+    return {"worker batch": batches}
+
+
+def scenarioRestart(args, prefs):
+    # Stop, stay down for an hour and start again. Groups that integrate their power must
+    # charge the downtime like their children do, so every group ends at its children's kWh.
+    groupIds = buildHouse(args.meters, args.group_size)
+    plugin = startPlugin(prefs)
+    plugin.nextPollTS = 0
+    plugin._runLoopOnce()
+    pump(plugin)
+    stopPlugin(plugin)
+    realTime = pluginModule.time
+    pluginModule.time = types.SimpleNamespace(**{name: getattr(realTime, name) for name in dir(realTime)
+                                                 if not name.startswith("_")})
+    pluginModule.time.time = lambda: realTime.time() + 3600
+    try:
+        start = time.perf_counter()
+        startPlugin(prefs)
+        restart = time.perf_counter() - start
+    finally:
+        pluginModule.time = realTime
+    if prefs.get("groupAccumulation", "power") == "power":
+        states = {devId: dev.states for devId, dev in fake_indigo.devices._devs.items()}
+        for groupId in groupIds + ([GROUP_BASE] if groupIds else []):
+            groupKwh = states[groupId]["accumEnergyTotal"]
+            childrenKwh = sum(states[int(childId)]["accumEnergyTotal"]
+                              for childId in fake_indigo.devices._devs[groupId].ownerProps["childEnergyMeters"])
+            if abs(groupKwh - childrenKwh) > 1e-6 * max(childrenKwh, 1):
+                raise AssertionError(f"Group {groupId} counted {groupKwh:.6f} kWh, its children {childrenKwh:.6f} kWh")
+    return {"restart": [restart]}
+
+
+SCENARIOS = {
+    "startup": scenarioStartup,
+    "tick": scenarioTick,
+    "ramp": scenarioRamp,
+    "group": scenarioGroup,
+    "delete": scenarioDelete,
+    "restart": scenarioRestart,
+}
+
+
+########################################
+# Reporting
+######################
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)] * 1000
+    return f"n={len(samples):<7} p50={pick(0.50):9.3f}ms p95={pick(0.95):9.3f}ms p99={pick(0.99):9.3f}ms " \
+           f"max={samples[-1] * 1000:9.3f}ms mean={statistics.mean(samples) * 1000:9.3f}ms"
+
+
+def runScenario(name, args, prefs):
+    fake_indigo.reset(args.latency_ms / 1000)
+    timings = SCENARIOS[name](args, prefs)
+    print(f"== {name}")
+    for label, samples in list(timings.items()) + list(fake_indigo.callbackTimes.items()):
+        if samples:
+            print(f"   {label:<14} {percentiles(samples)}")
+    for kind, count in sorted(fake_indigo.counters.items()):
+        print(f"   {kind:<28} {count}")
+
+
+def parsePref(text):
+    key, _, value = text.partition("=")
+    if value.lower() in ("true", "false"):
+        return key, value.lower() == "true"
+    return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append",
+                        help="scenario to run, can be repeated (default: all)")
+    parser.add_argument("--meters", type=int, default=10000)
+    parser.add_argument("--group-size", type=int, default=500, help="meters per group, 0 for no groups")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated IPC latency per server call")
+    parser.add_argument("--pref", type=parsePref, action="append", default=[], metavar="KEY=VALUE",
+                        help="plugin preference, e.g. refreshMode=event or batchRefresh=true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger().handlers[0].setLevel(logging.ERROR)  # the plugin announces its log level at INFO
+    prefs = {"deviceUpdate": "300", "loggingLevel": "40"}
+    prefs.update(args.pref)
+    print(f"meters={args.meters} group-size={args.group_size} latency={args.latency_ms}ms prefs={prefs}")
+    for name in args.scenario or SCENARIOS:
+        runScenario(name, args, prefs)
+
+
+if __name__ == "__main__":
+    main()
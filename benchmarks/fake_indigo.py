@@ -0,0 +1,240 @@
+"""In-process stand-in for the ``indigo`` module, just enough to drive plugin.py.
+
+Every server call (device fetch, iteration step, state update) can be given a
+simulated IPC latency and is counted, so benchmarks can report how much work the
+plugin asks of the Indigo server. Change notifications are queued like the real
+server does and delivered by ``devices.deliver()``.
+"""
+import atexit
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import types
+
+latency = 0.0
+counters = collections.Counter()
+_countersLock = threading.Lock()  # the plugin can write states from several threads
+callbackTimes = collections.defaultdict(list)
+_plugin = None
+# The plugin keeps its journal and history under here, every reset starts from an empty one
+_installFolder = tempfile.mkdtemp(prefix="fake_indigo_")
+atexit.register(shutil.rmtree, _installFolder, ignore_errors=True)
+
+
+def _ipc(kind):
+    with _countersLock:
+        counters[kind] += 1
+    if latency:
+        time.sleep(latency)
+
+
+def reset(ipcLatency=0.0):
+    global latency, _plugin
+    latency = ipcLatency
+    counters.clear()
+    callbackTimes.clear()
+    devices._devs.clear()
+    devices._notifications.clear()
+    devices._subscribed = False
+    _plugin = None
+    shutil.rmtree(_installFolder, ignore_errors=True)
+    os.makedirs(_installFolder)
+
+
+class Dict(dict):
+    pass
+
+
+class List(list):
+    pass
+
+
+class _Server:
+    def log(self, message, isError=False, type=None):
+        pass
+
+    def getInstallFolderPath(self):
+        return _installFolder
+
+
+server = _Server()
+
+
+class Device:
+    def __new__(cls, devId, name, deviceTypeId="", pluginId="", states=None, ownerProps=None, deviceClass="custom"):
+        # Like the real module, relays, dimmers and sensors are instances of their own classes
+        return object.__new__(DEVICE_CLASSES.get(deviceClass, cls) if cls is Device else cls)
+
+    def __init__(self, devId, name, deviceTypeId="", pluginId="", states=None, ownerProps=None, deviceClass="custom"):
+        self.id = devId
+        self.name = name
+        self.deviceTypeId = deviceTypeId
+        self.pluginId = pluginId
+        self.deviceClass = deviceClass
+        self.states = Dict(states or {})
+        self.ownerProps = Dict(ownerProps or {})
+        self.enabled = True
+        self.configured = True
+
+    def _copy(self):
+        dev = Device(self.id, self.name, self.deviceTypeId, self.pluginId, self.states, self.ownerProps, self.deviceClass)
+        dev.enabled = self.enabled
+        dev.configured = self.configured
+        return dev
+
+    def updateStatesOnServer(self, keyValueList):
+        _ipc("updateStatesOnServer")
+        devices._update(self.id, {kv['key']: kv['value'] for kv in keyValueList})
+        self.states.update((kv['key'], kv['value']) for kv in keyValueList)
+
+    def updateStateOnServer(self, key, value, uiValue=None):
+        self.updateStatesOnServer([{'key': key, 'value': value}])
+
+    def stateListOrDisplayStateIdChanged(self):
+        pass
+
+    def replacePluginPropsOnServer(self, props):
+        _ipc("replacePluginPropsOnServer")
+        master = devices._devs[self.id]
+        orig = master._copy()
+        master.ownerProps = Dict(props)
+        devices._notify(orig, master)
+
+
+class RelayDevice(Device):
+    pass
+
+
+class DimmerDevice(Device):
+    pass
+
+
+class SensorDevice(Device):
+    pass
+
+
+DEVICE_CLASSES = {"relay": RelayDevice, "dimmer": DimmerDevice, "sensor": SensorDevice}
+
+
+class _Devices:
+    def __init__(self):
+        self._devs = {}
+        self._notifications = collections.deque()
+        self._subscribed = False
+
+    def add(self, dev):
+        self._devs[dev.id] = dev
+        return dev
+
+    def __getitem__(self, devId):
+        _ipc("devices[]")
+        return self._devs[devId]._copy()
+
+    def __contains__(self, devId):
+        return devId in self._devs
+
+    def __len__(self):
+        return len(self._devs)
+
+    def __iter__(self):
+        return self.iter()
+
+    def iter(self, filter=""):
+        counters["devices.iter"] += 1
+        for dev in list(self._devs.values()):
+            if self._matches(dev, filter):
+                _ipc("devices.iter item")
+                yield dev._copy()
+
+    def _matches(self, dev, filter):
+        if not filter:
+            return True
+        for term in (term.strip() for term in filter.split(",")):
+            if term == "self" and dev.pluginId == _plugin.pluginId:
+                return True
+            if term.startswith("indigo.") and dev.deviceClass == term[7:]:
+                return True
+            if term.startswith("props.") and dev.ownerProps.get(term[6:]):
+                return True
+        return False
+
+    def subscribeToChanges(self):
+        self._subscribed = True
+
+    def delete(self, devId):
+        dev = self._devs.pop(devId)
+        if _plugin is not None:
+            if dev.pluginId == _plugin.pluginId:
+                _plugin.deviceStopComm(dev._copy())
+            self._timed("deviceDeleted", _plugin.deviceDeleted, dev._copy())
+
+    def setStates(self, devId, **states):
+        # A change made by something other than the plugin, like a dimmer being ramped
+        self._update(devId, states)
+
+    def _update(self, devId, states):
+        master = self._devs.get(devId)
+        if master is None:
+            return
+        orig = master._copy()
+        master.states.update(states)
+        self._notify(orig, master)
+
+    def _notify(self, orig, master):
+        if self._subscribed or master.pluginId == _plugin.pluginId:
+            self._notifications.append((orig, master._copy()))
+
+    def deliver(self):
+        while self._notifications:
+            orig, new = self._notifications.popleft()
+            self._timed("deviceUpdated", _plugin.deviceUpdated, orig, new)
+
+    def _timed(self, name, callback, *args):
+        start = time.perf_counter()
+        callback(*args)
+        callbackTimes[name].append(time.perf_counter() - start)
+
+
+devices = _Devices()
+variables = Dict()
+
+kDeviceGeneralAction = types.SimpleNamespace(Beep=0, EnergyUpdate=1, EnergyReset=2, RequestStatus=3)
+kSensorAction = types.SimpleNamespace(TurnOn=0, TurnOff=1, Toggle=2)
+kDimmerRelayAction = types.SimpleNamespace(TurnOn=0, TurnOff=1, Toggle=2, SetBrightness=3, BrightenBy=4, DimBy=5,
+                                           SetColorLevels=6)
+
+
+class PluginBase:
+    class StopThread(Exception):
+        pass
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        global _plugin
+        _plugin = self
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = pluginPrefs
+        self.logger = logging.getLogger("Plugin")
+        self.stopThread = False
+
+    def sleep(self, seconds):
+        if self.stopThread:
+            raise self.StopThread()
+        time.sleep(seconds)
+
+    def stopConcurrentThread(self):
+        self.stopThread = True
+
+    def deviceCreated(self, dev):
+        pass
+
+    def deviceUpdated(self, origDev, newDev):
+        pass
+
+    def deviceDeleted(self, dev):
+        pass